@@ -1,30 +1,57 @@
 import logging
 import os
 import json
+import re
+import secrets
+import heapq
+import itertools
+import sqlite3
+import math
+import threading
+from bisect import bisect_left
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 import random
 import asyncio
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from cachetools import TTLCache
 import time
 
-import traceback
-from keep_alive import run_flask, ping_server
-from threading import Thread
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    orjson = None
+
+try:
+    from numba import njit, types as numba_types
+    from numba.typed import List as NumbaList
+except ImportError:  # numba is optional, the search scan then runs as plain Python
+    njit = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional (and not available on Windows)
+    uvloop = None
+from keep_alive import start_web_server, ping_server
 
 # Add GitHub storage import
-from github_storage import init_github_storage, load_materials, save_materials
+from github_storage import init_github_storage, load_materials, asave_materials
 
-from user_tracking import init_user_tracker, track_user_interaction, get_user_stats
+from user_tracking import (
+    init_user_tracker, track_user_interaction, get_user_stats, flush_user_stats,
+    user_stats_snapshot, user_stats_saved, USER_STATS_FILE, USER_STATS_FLUSH_INTERVAL,
+)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Enhanced error handler with detailed logging"""
+    # exc_info carries the full traceback of the handler's exception
     logger.error("Exception while handling an update:", exc_info=context.error)
     
-    # Get detailed error information
-    error_traceback = traceback.format_exc()
-    logger.error(f"Full error traceback:\n{error_traceback}")
-    
     # Send a more specific error message to the user
     if update and update.effective_chat:
         text = "❌ Sorry, an error occurred. The issue has been logged and will be fixed soon."
@@ -36,6 +63,10 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # Import configuration
 import config
 
+# Role lookups as sets; team access includes admins
+_ADMIN_IDS = frozenset(config.ADMIN_IDS)
+_TEAM_IDS = frozenset(config.TEAM_MEMBER_IDS) | _ADMIN_IDS
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
@@ -69,6 +100,224 @@ logger = logging.getLogger(__name__)
     
 ) = range(17)
 
+# Static keyboards, built once and shared by every request
+_ADMIN_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔍 Search", callback_data="search"),
+        InlineKeyboardButton("📂 Browse", callback_data="browse"),
+    ],
+    [
+        InlineKeyboardButton("📤 Upload Material", callback_data="upload_menu"),
+        InlineKeyboardButton("👥 Manage Team", callback_data="manage_team"),
+    ],
+    [
+        InlineKeyboardButton("📊 Stats", callback_data="admin_stats"),
+        InlineKeyboardButton("❤️ Donate", callback_data="donate"),
+    ],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="help")],
+])
+
+# Team member menu (upload access only)
+_TEAM_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔍 Search", callback_data="search"),
+        InlineKeyboardButton("📂 Browse", callback_data="browse"),
+    ],
+    [InlineKeyboardButton("📤 Upload Material", callback_data="upload_menu")],
+    [
+        InlineKeyboardButton("❤️ Donate", callback_data="donate"),
+        InlineKeyboardButton("ℹ️ Help", callback_data="help"),
+    ],
+])
+
+_USER_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔍 Search", callback_data="search"),
+        InlineKeyboardButton("📂 Browse by Branch", callback_data="browse"),
+    ],
+    [
+        InlineKeyboardButton("❤️ Donate", callback_data="donate"),
+        InlineKeyboardButton("ℹ️ Help", callback_data="help")
+    ],
+])
+
+# Upload reply templates; only the per-upload fields are filled in with str.format
+_UPLOAD_OK_TMPL = (
+    "🎉 **Material Uploaded Successfully!**\n\n"
+    "👤 **Uploaded by:** {user}\n"
+    "🏛️ **Branch:** {branch}\n"
+    "📅 **Semester:** {semester}\n"
+    "📚 **Subject:** {subject}\n"
+    "📄 **Title:** {title}\n"
+    "🔍 **Keywords:** {keywords}\n\n"
+    "✅ The material is now available to users."
+)
+
+_ADMIN_UPLOAD_OK_TMPL = (
+    "🎉 **Material Uploaded Successfully!**\n\n"
+    "🏛️ **Branch:** {branch}\n"
+    "📅 **Semester:** {semester}\n"
+    "📚 **Subject:** {subject}\n"
+    "📄 **Title:** {title}\n"
+    "🔍 **Keywords:** {keywords}\n"
+    "🆔 **File ID:** `{file_id}`\n\n"
+    "✅ The material is now available to users."
+)
+
+# Shared by the team and admin upload handlers
+_UPLOAD_ERR_TMPL = (
+    "❌ **Error:** {error}\n\n"
+    "📝 **Please try again with this format:**\n"
+    "`Branch, Semester, Subject, Title, Keywords`\n\n"
+    "**Example:**\n"
+    "`CSE, 4, DBMS, DBMS Module 3 Notes, dbms module3 normalization`\n\n"
+    "💡 **Tips:**\n"
+    "- Use exact branch names: CSE, ECE, EEE, Mech, Civil\n"
+    "- Semester must be 1-8\n"
+    "- Add multiple keywords for better search"
+)
+
+# Message templates for the download flow; settings that never change at runtime
+# are filled in once here, the rest with str.format per message
+_AD_VERIF_TMPL = (
+    "📊 **Your Download Status**\n"
+    f"• Free downloads used: {{free_used}}/{config.FREE_DOWNLOADS_ALLOWED}\n"
+    "• Free downloads reset in: {reset_hours}h {reset_minutes}m\n\n"
+    "📢 **Ad Verification Required**\n\n"
+    "To download **{title}**, please:\n\n"
+    "1. 🔗 **Click the ad link below**\n"
+    f"2. ⏳ **Keep it open for {config.WAIT_TIME_SECONDS} seconds**\n"
+    "3. ✅ **Return and click 'Verify & Download'**\n"
+    f"4. 🎉 **Get {config.TOKEN_DURATION_HOURS}-hour unlimited downloads!**\n\n"
+    "**Ad Sponsor:** {sponsor}\n\n"
+    "This helps us keep the bot free! 🙏"
+)
+
+_DEBUG_TMPL = (
+    "\n"
+    "🔧 **Debug Information - User {user_id}**\n\n"
+    "**Current Status:**\n"
+    "- Free Downloads Used: {free_remaining}/{free_total}\n"
+    "- Status: {status}\n"
+    "- Total Downloads: {total_downloads}\n"
+    "- Reset In: {hours_until_reset}h {minutes_until_reset}m\n\n"
+    "**System State:**\n"
+    "- AD_VERIFICATION_ENABLED: {ads_enabled}\n"
+    f"- FREE_DOWNLOADS_ALLOWED: {config.FREE_DOWNLOADS_ALLOWED}\n"
+    f"- TOKEN_DURATION_HOURS: {config.TOKEN_DURATION_HOURS}\n"
+)
+
+# Download status messages by get_user_status()['status'], filled with str.format_map(status);
+# the time fields are whole-number floats, hence :.0f
+_STATUS_TMPLS = {
+    'free_downloads': (
+        "📊 **Your Download Status**\n\n"
+        "🎉 **Free Downloads Available!**\n"
+        f"• Free downloads left: **{{free_remaining}}/{config.FREE_DOWNLOADS_ALLOWED}**\n"
+        "• Free downloads reset in: **{hours_until_reset:.0f}h {minutes_until_reset:.0f}m**\n"
+        "• Total downloads: {total_downloads}\n\n"
+        f"💡 After {config.FREE_DOWNLOADS_ALLOWED} free downloads, watch one ad for {config.WAIT_TIME_SECONDS} seconds to get {config.TOKEN_DURATION_HOURS} hours of unlimited downloads!"
+    ),
+    'token_active': (
+        "📊 **Your Download Status**\n\n"
+        "✅ **Token Active!**\n"
+        f"• Free downloads used: {{free_remaining}}/{config.FREE_DOWNLOADS_ALLOWED}\n"
+        "• Token expires in: **{token_hours_left:.0f}h {token_minutes_left:.0f}m**\n"
+        "• Free downloads reset in: {hours_until_reset:.0f}h {minutes_until_reset:.0f}m\n"
+        "• Total downloads: {total_downloads}\n\n"
+        "🎉 You can download **unlimited materials** until token expires!"
+    ),
+    'needs_ad': (
+        "📊 **Your Download Status**\n\n"
+        "📢 **Ad Watch Required**\n"
+        f"• Free downloads used: {config.FREE_DOWNLOADS_ALLOWED}/{config.FREE_DOWNLOADS_ALLOWED}\n"
+        "• Free downloads reset in: **{hours_until_reset:.0f}h {minutes_until_reset:.0f}m**\n"
+        "• Total downloads: {total_downloads}\n\n"
+        f"💡 Watch one ad for **{config.WAIT_TIME_SECONDS} seconds** to get **{config.TOKEN_DURATION_HOURS} hours** of unlimited downloads!"
+    ),
+}
+
+_UPLOAD_CANCEL_KB = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="back_to_start")]])
+_ADMIN_UPLOAD_CANCEL_KB = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Upload", callback_data="back_to_start")]])
+
+_UPLOAD_DONE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Upload Another", callback_data="upload_menu")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+_ADMIN_UPLOAD_DONE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Upload Another", callback_data="admin_upload")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+
+_BACK_TO_START_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]])
+_BACK_TO_SUBJECTS_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back_to_subjects")]])
+
+# Footer row under every page of search results
+_SEARCH_RESULTS_FOOTER = [
+    InlineKeyboardButton("🔍 New Search", callback_data="search"),
+    InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
+]
+
+_STATUS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Continue Browsing", callback_data="back_to_subjects")],
+    [InlineKeyboardButton("🔍 Search Materials", callback_data="search")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+
+# After a verified (ad) download
+_VERIFIED_DOWNLOAD_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 More Materials", callback_data="back_to_subjects")],
+    [InlineKeyboardButton("📊 My Status", callback_data="show_my_status")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+
+# After a direct download, depending on where it was opened from
+_SENT_FROM_SEARCH_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Results", callback_data="back_to_search")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+_SENT_FROM_BROWSE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Materials", callback_data="back_to_subjects")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+
+_DONATION_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💖 Copy UPI ID", callback_data="copy_upi")],
+    [InlineKeyboardButton("📞 Contact Admin", url="https://t.me/your_admin_bot")],
+    [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_start")],
+])
+
+_NO_RESULTS_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔍 Search Again", callback_data="search"),
+        InlineKeyboardButton("📂 Browse by Branch", callback_data="browse"),
+    ],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
+])
+
+_BRANCHES_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("💻 CSE", callback_data="CSE"),
+        InlineKeyboardButton("📡 ECE", callback_data="ECE"),
+    ],
+    [
+        InlineKeyboardButton("⚡ EEE", callback_data="EEE"),
+        InlineKeyboardButton("🔧 Mech", callback_data="Mech"),
+    ],
+    [
+        InlineKeyboardButton("🏗️ Civil", callback_data="Civil"),
+        InlineKeyboardButton("🔙 Back", callback_data="back_to_start"),
+    ],
+])
+
+_SEMESTERS_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"Sem {i}", callback_data=str(i)) for i in row] for row in ((1, 2), (3, 4), (5, 6), (7, 8))]
+    + [[
+        InlineKeyboardButton("🔙 Back to Branches", callback_data="back_to_branches"),
+        InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
+    ]]
+)
+
 # Ensure PDF folder exists
 if not os.path.exists(config.PDF_FOLDER):
     os.makedirs(config.PDF_FOLDER)
@@ -109,6 +358,51 @@ if not os.path.exists(config.PDF_FOLDER):
 # Load materials at startup
 STUDY_MATERIALS = load_materials()
 
+# File types team members may upload
+_ALLOWED_EXTS = frozenset({'.pdf', '.doc', '.docx', '.txt', '.jpg', '.png'})
+
+# Upload detail validation
+_BRANCH_NAMES = ("CSE", "ECE", "EEE", "Mech", "Civil")
+_VALID_BRANCHES = frozenset(_BRANCH_NAMES)
+_VALID_BRANCHES_STR = ", ".join(_BRANCH_NAMES)
+_VALID_SEMS = frozenset("12345678")
+_UPLOAD_RE = re.compile(
+    r"\s*(CSE|ECE|EEE|Mech|Civil)\s*,\s*([1-8])\s*,\s*([^,]*[^,\s])\s*,\s*([^,]*[^,\s])\s*,(.+)\Z",
+    re.DOTALL
+)
+
+# Cached copy of the local materials file, re-parsed only when its mtime changes
+_MATERIALS_MTIME = 0.0
+_LOCAL_MATERIALS = None
+
+def _json_loads(raw):
+    """Parse JSON bytes or text, using orjson when available."""
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def _json_dumps(obj):
+    """Serialize to compact JSON text, using orjson when available."""
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj, separators=(',', ':'))
+
+def _json_dumps_file(obj):
+    """Serialize to indented UTF-8 JSON bytes for a data file."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+def load_local_materials():
+    """Load the local materials file, serving it from memory if unchanged.
+
+    Raises FileNotFoundError if the file does not exist.
+    """
+    global _MATERIALS_MTIME, _LOCAL_MATERIALS
+    
+    mtime = os.path.getmtime(config.DATA_FILE)
+    if _LOCAL_MATERIALS is None or mtime != _MATERIALS_MTIME:
+        with open(config.DATA_FILE, 'rb') as f:
+            _LOCAL_MATERIALS = _json_loads(f.read())
+        _MATERIALS_MTIME = mtime
+    return _LOCAL_MATERIALS
+
 # Debug: Check what's loaded
 print("🔍 DEBUG: Data loaded successfully!")
 print(f"🔍 DEBUG: Available branches: {list(STUDY_MATERIALS.keys())}")
@@ -117,119 +411,275 @@ for branch in STUDY_MATERIALS:
     for semester in STUDY_MATERIALS[branch]:
         print(f"🔍 DEBUG:   Semester {semester} has subjects: {list(STUDY_MATERIALS[branch][semester].keys())}")
 
-def search_materials(query):
-    """Search materials by keyword."""
-    query = query.lower().strip()
-    results = []
+# Every material in one flat list, each entry carrying its coordinates:
+# {"branch", "semester", "subject", "material", "material_index"}. Writes still go to STUDY_MATERIALS.
+_ALL_MATERIALS = []
+
+# (branch, semester, subject) -> that subject's materials list (the same list object)
+MATERIALS_INDEX = {}
+
+# Search index: token -> list of positions in _ALL_MATERIALS
+KEYWORD_INDEX = {}   # title and keyword tokens
+SUBJECT_INDEX = {}   # subject name tokens
+BRANCH_INDEX = {}    # branch name tokens
+_INDEX_KEYS = []     # sorted tokens of both indexes, for prefix lookups
+
+# Flat, lowercased copies of the searchable text for substring scans.
+# Position i in each array belongs to _ALL_MATERIALS[i].
+_SCAN_TITLES = []
+_SCAN_SUBJECTS = []
+_SCAN_KEYWORDS = []
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def _to_scan_array(strings):
+    """Turn a list of strings into an array the substring scan can iterate over."""
+    if njit:
+        # One extend converts the whole list in compiled code, unlike per-item appends
+        array = NumbaList.empty_list(numba_types.unicode_type)
+        array.extend(strings)
+        return array
+    return strings
+
+def _substring_scan(query, titles, subjects, keywords, limit):
+    """Return the positions whose title, subject or keywords contain query.
+
+    Stops after limit hits (0 for no limit); positions come out in ascending order.
+    """
+    hits = []
+    for i in range(len(titles)):
+        if query in titles[i] or query in subjects[i] or query in keywords[i]:
+            hits.append(i)
+            if len(hits) == limit:
+                break
+    return hits
+
+if njit:
+    _substring_scan = njit(cache=True)(_substring_scan)
+
+def warm_up_search():
+    """Compile the numba substring scan now rather than inside the first search (blocking)."""
+    if njit:
+        _substring_scan("\0", _SCAN_TITLES, _SCAN_SUBJECTS, _SCAN_KEYWORDS, 1)
+
+def _add_to_index(index, token, pos):
+    """Add a material position to an index under the given token."""
+    postings = index.get(token)
+    if postings is None:
+        index[token] = postings = []
+        # Keep the combined key list sorted and free of duplicates
+        key_pos = bisect_left(_INDEX_KEYS, token)
+        if key_pos == len(_INDEX_KEYS) or _INDEX_KEYS[key_pos] != token:
+            _INDEX_KEYS.insert(key_pos, token)
+    postings.append(pos)
+
+def _index_material(branch, semester, subject, material_index, material, subject_lower=None):
+    """Add a single material to the flat list and the search index."""
+    pos = len(_ALL_MATERIALS)
+    _ALL_MATERIALS.append({
+        "branch": branch,
+        "semester": semester,
+        "subject": subject,
+        "material": material,
+        "material_index": material_index
+    })
+    
+    # Lowercase each searchable string once; tokens and scan arrays share the result
+    title_lower = material.get("title", "").lower()
+    keywords_lower = "\n".join(material.get("keywords", [])).lower()
+    if subject_lower is None:
+        subject_lower = subject.lower()
+    
+    for token in set(_TOKEN_RE.findall(title_lower)) | set(_TOKEN_RE.findall(keywords_lower)):
+        _add_to_index(KEYWORD_INDEX, token, pos)
+    
+    for token in set(_TOKEN_RE.findall(subject_lower)):
+        _add_to_index(SUBJECT_INDEX, token, pos)
+    
+    _add_to_index(BRANCH_INDEX, branch.lower(), pos)
+    
+    _SCAN_TITLES.append(title_lower)
+    _SCAN_SUBJECTS.append(subject_lower)
+    _SCAN_KEYWORDS.append(keywords_lower)
+    
+    # Cached results may be missing this material now
+    _search_cached.cache_clear()
+
+def build_search_index():
+    """Rebuild the search index from STUDY_MATERIALS."""
+    global _SCAN_TITLES, _SCAN_SUBJECTS, _SCAN_KEYWORDS
+    
+    KEYWORD_INDEX.clear()
+    SUBJECT_INDEX.clear()
+    BRANCH_INDEX.clear()
+    MATERIALS_INDEX.clear()
+    _INDEX_KEYS.clear()
+    _ALL_MATERIALS.clear()
+    # Plain lists while building; converted in bulk below
+    _SCAN_TITLES = []
+    _SCAN_SUBJECTS = []
+    _SCAN_KEYWORDS = []
     
     for branch, semesters in STUDY_MATERIALS.items():
         for semester, subjects in semesters.items():
             for subject, data in subjects.items():
-                for material in data.get("materials", []):
-                    # Search in title
-                    if query in material["title"].lower():
-                        results.append({
-                            "branch": branch,
-                            "semester": semester,
-                            "subject": subject,
-                            "material": material
-                        })
-                    # Search in keywords
-                    elif any(query in keyword for keyword in material.get("keywords", [])):
-                        results.append({
-                            "branch": branch,
-                            "semester": semester,
-                            "subject": subject,
-                            "material": material
-                        })
-                    # Search in subject name
-                    elif query in subject.lower():
-                        results.append({
-                            "branch": branch,
-                            "semester": semester,
-                            "subject": subject,
-                            "material": material
-                        })
-    
-    return results
+                subject_lower = subject.lower()
+                if "materials" in data:
+                    MATERIALS_INDEX[(branch, semester, subject)] = data["materials"]
+                for i, material in enumerate(data.get("materials", [])):
+                    _index_material(branch, semester, subject, i, material, subject_lower)
+    
+    _SCAN_TITLES = _to_scan_array(_SCAN_TITLES)
+    _SCAN_SUBJECTS = _to_scan_array(_SCAN_SUBJECTS)
+    _SCAN_KEYWORDS = _to_scan_array(_SCAN_KEYWORDS)
+    logger.info(f"Search index built: {len(_INDEX_KEYS)} tokens")
+
+def _lookup_prefix(token):
+    """Get all material positions for index tokens starting with token."""
+    refs = set()
+    i = bisect_left(_INDEX_KEYS, token)
+    while i < len(_INDEX_KEYS) and _INDEX_KEYS[i].startswith(token):
+        key = _INDEX_KEYS[i]
+        refs.update(KEYWORD_INDEX.get(key, ()))
+        refs.update(SUBJECT_INDEX.get(key, ()))
+        refs.update(BRANCH_INDEX.get(key, ()))
+        i += 1
+    return refs
+
+# Debounced saving: uploads mark the data dirty and a background task writes it
+SAVE_DELAY_SECONDS = 5  # Coalesce uploads arriving within this window into one save
+SAVE_RETRY_DELAY = 60  # seconds to wait after a failed save before trying again
+_materials_dirty = asyncio.Event()
+_dirty_branches = set()  # only these branches' files are re-sent by the next save
+_save_task = None
+# Every upload of user_stats.json (own flush or inside a materials commit) holds this
+_user_stats_lock = asyncio.Lock()
+
+def schedule_materials_save(branch):
+    """Mark a branch of STUDY_MATERIALS as changed so the save worker writes it soon."""
+    _dirty_branches.add(branch)
+    _materials_dirty.set()
+
+def _take_dirty_branches():
+    """The branches changed since the last save; resets the pending save."""
+    branches = set(_dirty_branches)
+    _dirty_branches.clear()
+    _materials_dirty.clear()
+    return branches
+
+def _restore_dirty_branches(branches):
+    """Put back branches taken for a save that did not go through."""
+    if branches:
+        _dirty_branches.update(branches)
+        _materials_dirty.set()
+
+async def save_pending_materials():
+    """Save the dirty branches, committing pending user stats along with them.
+
+    On failure the branches are marked dirty again so a later save retries them.
+    """
+    # Held from snapshot to saved() so a user-stats flush can't land in between
+    async with _user_stats_lock:
+        snapshot = await asyncio.to_thread(user_stats_snapshot)
+        extra_files = {USER_STATS_FILE: snapshot[0]} if snapshot else None
+        branches = _take_dirty_branches()
+        try:
+            ok = await asave_materials(STUDY_MATERIALS, branches, len(_ALL_MATERIALS), extra_files)
+        except Exception:
+            _restore_dirty_branches(branches)
+            raise
+        if ok is None:
+            # GitHub storage is disabled: nowhere to save to, so nothing to retry
+            return ok
+        if not ok:
+            _restore_dirty_branches(branches)
+        elif snapshot:
+            await asyncio.to_thread(user_stats_saved, snapshot[1])
+        return ok
+
+async def _save_worker():
+    """Save STUDY_MATERIALS in the background whenever it is marked dirty."""
+    while True:
+        await _materials_dirty.wait()
+        await asyncio.sleep(SAVE_DELAY_SECONDS)
+        try:
+            ok = await save_pending_materials()
+        except Exception as e:
+            logger.error(f"Background save failed: {e}")
+            ok = False
+        if ok is False:
+            logger.warning(f"Materials save failed, retrying in {SAVE_RETRY_DELAY}s")
+            await asyncio.sleep(SAVE_RETRY_DELAY)
+
+SEARCH_PAGE_SIZE = 10  # Results shown (and collected) per search
+
+def search_materials(query, limit=None):
+    """Search materials by keyword, returning at most limit results (all if None)."""
+    return list(_search_cached(query.lower().strip(), limit or 0))
+
+@lru_cache(maxsize=512)
+def _search_cached(query, limit):
+    """Search the index for an already normalized query. Cleared whenever the index changes."""
+    if not query:
+        return ()
+    tokens = _TOKEN_RE.findall(query)
+    if tokens:
+        # Every query token has to match (as a prefix) a title, keyword, subject or branch token;
+        # intersect starting from the smallest candidate set
+        candidates = sorted((_lookup_prefix(token) for token in set(tokens)), key=len)
+        matched = candidates[0].intersection(*candidates[1:])
+    else:
+        # Nothing to look up (e.g. "++" or "#"), only the substring scan can match it
+        matched = set()
+    
+    # Token hits come first, in material order; only the first limit are needed
+    positions = heapq.nsmallest(limit, matched) if 0 < limit < len(matched) else sorted(matched)
+    if 0 < limit <= len(positions):
+        return tuple(_ALL_MATERIALS[i] for i in positions)
+    
+    # Then in-word matches the index can't see (e.g. "base" in "database"). The scan
+    # may return token hits too, so ask for enough to fill the rest after dropping them
+    scan_limit = limit + len(positions) if limit else 0
+    hits = _substring_scan(query, _SCAN_TITLES, _SCAN_SUBJECTS, _SCAN_KEYWORDS, scan_limit)
+    extra = [i for i in hits if i not in matched]
+    if limit:
+        extra = extra[:limit - len(positions)]
+    return tuple(_ALL_MATERIALS[i] for i in positions + extra)
+
+build_search_index()
 
 # Start command handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send greeting message and show main menu options."""
     user = update.effective_user
     # Track user interaction
-    try:
-        from user_tracking import track_user_interaction
-        track_user_interaction(
-            user_id=user.id,
-            username=user.username or "No username",
-            first_name=user.first_name or "Unknown",
-            action="start"
-        )
-    except Exception as e:
-        print(f"⚠️ Could not track user: {e}")
+    track_in_background(user, "start")
     
-    user_role = get_user_role(user.id)
+    # Work out the role once per session; later handlers read it from user_data
+    role = context.user_data['role'] = _lookup_role(user.id)
 
     # Check if user is admin
-    if user.id in config.ADMIN_IDS:
+    if role == "admin":
         welcome_text = (
             f"👋 Welcome Admin {user.first_name}! 📚\n\n"
             "You have administrative privileges. "
             "Please choose an option below:"
         )
-        # Full admin menu
-        keyboard = [
-            [
-                InlineKeyboardButton("🔍 Search", callback_data="search"),
-                InlineKeyboardButton("📂 Browse", callback_data="browse"),
-            ],
-            [
-                InlineKeyboardButton("📤 Upload Material", callback_data="upload_menu"),
-                InlineKeyboardButton("👥 Manage Team", callback_data="manage_team"),
-            ],
-            [
-                InlineKeyboardButton("📊 Stats", callback_data="admin_stats"),
-                InlineKeyboardButton("❤️ Donate", callback_data="donate"),
-            ],
-            [InlineKeyboardButton("ℹ️ Help", callback_data="help")],
-        ]
-    elif user.id in config.TEAM_MEMBER_IDS:
+        reply_markup = _ADMIN_KB
+    elif role == "team":
         welcome_text = (
             f"👋 Welcome Member {user.first_name}! 📚\n\n"
             "You have Member privileges. "
             "Please choose an option below:"
         )
-        # Team member menu (upload access only)
-        keyboard = [
-            [
-                InlineKeyboardButton("🔍 Search", callback_data="search"),
-                InlineKeyboardButton("📂 Browse", callback_data="browse"),
-            ],
-            [InlineKeyboardButton("📤 Upload Material", callback_data="upload_menu")],
-            [
-                InlineKeyboardButton("❤️ Donate", callback_data="donate"),
-                InlineKeyboardButton("ℹ️ Help", callback_data="help"),
-            ],
-        ]
+        reply_markup = _TEAM_KB
     else:
         welcome_text = (
             f"👋 Welcome {user.first_name} to the Study Material Bot! 📚\n\n"
             "I'm here to help you find study materials for your courses. "
             "Please choose an option below:"
         )
-        keyboard = [
-            [
-                InlineKeyboardButton("🔍 Search", callback_data="search"),
-                InlineKeyboardButton("📂 Browse by Branch", callback_data="browse"),
-            ],
-            [
-                InlineKeyboardButton("❤️ Donate", callback_data="donate"),
-                InlineKeyboardButton("ℹ️ Help", callback_data="help")
-            ],
-        ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _USER_KB
     
     if update.message:
         await update.message.reply_text(welcome_text, reply_markup=reply_markup)
@@ -243,11 +693,11 @@ async def show_upload_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Show upload menu for team members and admins"""
     user = update.effective_user
     
-    if not is_team_member(user.id):
+    if not is_team_member_ctx(context, user.id):
         await update.callback_query.edit_message_text("❌ Upload access required. Contact admin.")
         return await start(update, context)
     
-    user_role = get_user_role(user.id)
+    user_role = _ROLE_LABELS[get_cached_role(context, user.id)]
     
     text = (
         f"📤 **Upload Materials** - {user_role}\n\n"
@@ -259,29 +709,26 @@ async def show_upload_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "Click Cancel to go back."
     )
     
-    keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data="back_to_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.callback_query.edit_message_text(text, reply_markup=_UPLOAD_CANCEL_KB, parse_mode="Markdown")
     return UPLOAD_FILE
 
 async def handle_team_upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle file upload from team members"""
     user = update.effective_user
     
-    if not is_team_member(user.id):
+    if not is_team_member_ctx(context, user.id):
         await update.message.reply_text("❌ Upload access required.")
         return await start(update, context)
     
-    if update.message.document:
-        file = await update.message.document.get_file()
-        file_id = update.message.document.file_id
-        file_name = update.message.document.file_name
-        file_size = update.message.document.file_size
+    doc = update.message.document
+    if doc:
+        file_id = doc.file_id
+        file_name = doc.file_name
+        file_size = doc.file_size
         
         # Validate file type
-        allowed_types = ['.pdf', '.doc', '.docx', '.txt', '.jpg', '.png']
-        if not any(file_name.lower().endswith(ext) for ext in allowed_types):
+        ext = os.path.splitext(file_name)[1].lower()
+        if ext not in _ALLOWED_EXTS:
             await update.message.reply_text("❌ Please upload PDF, Word, text, or image files only.")
             return UPLOAD_FILE
         
@@ -297,6 +744,7 @@ async def handle_team_upload_file(update: Update, context: ContextTypes.DEFAULT_
         
         # # Download file to local storage for backup
         # try:
+        #     file = await doc.get_file()
         #     downloaded_file = await file.download_to_drive(f"{config.PDF_FOLDER}{file_name}")
         #     logger.info(f"✅ File saved by {user.first_name}: {downloaded_file}")
         # except Exception as e:
@@ -323,11 +771,61 @@ async def handle_team_upload_file(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("❌ Please send a file (PDF, Word, etc.)")
         return UPLOAD_FILE
 
+def _parse_upload_details(text):
+    """Parse upload details in the form 'Branch, Semester, Subject, Title, Keywords'.
+
+    Raises ValueError with a user-facing message when the details are invalid.
+    """
+    # Well-formed details validate in a single match
+    m = _UPLOAD_RE.match(text)
+    if m:
+        branch, semester, subject, title, keywords = m.groups()
+        return branch, semester, subject, title, [k.strip().lower() for k in keywords.split(',')]
+    
+    # Otherwise work out what is wrong so the user gets a specific message
+    parts = [part.strip() for part in text.split(',')]
+    if len(parts) < 5:
+        raise ValueError("❌ Not enough details. Need: Branch, Semester, Subject, Title, Keywords")
+    
+    branch, semester, subject, title = parts[0], parts[1], parts[2], parts[3]
+    keywords = [k.strip().lower() for k in parts[4:]]
+    
+    # Validate inputs
+    if branch not in _VALID_BRANCHES:
+        raise ValueError(f"❌ Invalid branch: {branch}. Use: {_VALID_BRANCHES_STR}")
+    
+    if semester not in _VALID_SEMS:
+        raise ValueError("❌ Invalid semester. Use a number between 1-8")
+    
+    if not subject:
+        raise ValueError("❌ Subject cannot be empty")
+    if not title:
+        raise ValueError("❌ Title cannot be empty")
+    if not keywords:
+        raise ValueError("❌ Please provide at least one keyword")
+    
+    return branch, semester, subject, title, keywords
+
+def _append_material(branch, semester, subject, new_material):
+    """Add a material to STUDY_MATERIALS, index it and schedule a save.
+
+    Returns the number of materials now in the subject.
+    """
+    # Create structure if not exists
+    subjects = STUDY_MATERIALS.setdefault(branch, {}).setdefault(semester, {})
+    materials = subjects.setdefault(subject, {"materials": []})["materials"]
+    MATERIALS_INDEX[(branch, semester, subject)] = materials
+    
+    materials.append(new_material)
+    _index_material(branch, semester, subject, len(materials) - 1, new_material)
+    schedule_materials_save(branch)
+    return len(materials)
+
 async def handle_team_upload_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle text input during team member upload with enhanced debugging"""
     user = update.effective_user
     
-    if not is_team_member(user.id):
+    if not is_team_member_ctx(context, user.id):
         await update.message.reply_text("❌ Upload access required.")
         return await start(update, context)
     
@@ -337,41 +835,8 @@ async def handle_team_upload_text(update: Update, context: ContextTypes.DEFAULT_
         return UPLOAD_DETAILS
     
     try:
-        # Parse the details
-        parts = [part.strip() for part in update.message.text.split(',')]
-        if len(parts) < 5:
-            raise ValueError("❌ Not enough details. Need: Branch, Semester, Subject, Title, Keywords")
-        
-        branch, semester, subject, title = parts[0], parts[1], parts[2], parts[3]
-        keywords = [k.strip().lower() for k in parts[4:]]
-        
-        # Validate inputs
-        valid_branches = ["CSE", "ECE", "EEE", "Mech", "Civil"]
-        if branch not in valid_branches:
-            raise ValueError(f"❌ Invalid branch: {branch}. Use: {', '.join(valid_branches)}")
-        
-        if not semester.isdigit() or not (1 <= int(semester) <= 8):
-            raise ValueError("❌ Invalid semester. Use a number between 1-8")
-        
-        if not subject.strip():
-            raise ValueError("❌ Subject cannot be empty")
-        if not title.strip():
-            raise ValueError("❌ Title cannot be empty")
-        if not keywords:
-            raise ValueError("❌ Please provide at least one keyword")
-        
-        print(f"🔄 Processing upload: {branch}, Sem {semester}, {subject}, '{title}'")
-        
-        # CRITICAL: Ensure STUDY_MATERIALS is the global variable
-        global STUDY_MATERIALS
-        
-        # Create structure if not exists
-        if branch not in STUDY_MATERIALS:
-            STUDY_MATERIALS[branch] = {}
-        if semester not in STUDY_MATERIALS[branch]:
-            STUDY_MATERIALS[branch][semester] = {}
-        if subject not in STUDY_MATERIALS[branch][semester]:
-            STUDY_MATERIALS[branch][semester][subject] = {"materials": []}
+        branch, semester, subject, title, keywords = _parse_upload_details(update.message.text)
+        logger.debug("🔄 Processing upload: %s, Sem %s, %s, '%s'", branch, semester, subject, title)
         
         # Add material
         new_material = {
@@ -383,40 +848,14 @@ async def handle_team_upload_text(update: Update, context: ContextTypes.DEFAULT_
             "uploaded_at": datetime.now().isoformat()
         }
         
-        print(f"➕ Adding material to: {branch}/{semester}/{subject}")
-        STUDY_MATERIALS[branch][semester][subject]["materials"].append(new_material)
-        
-        # CRITICAL: Count materials before save
-        materials_count = len(STUDY_MATERIALS[branch][semester][subject]["materials"])
-        print(f"📊 Material added. Now {materials_count} materials in {subject}")
-        
-        # Save to storage
-        print("💾 Calling save_materials...")
-        save_materials(STUDY_MATERIALS)
-        print("✅ save_materials completed")
-        
-        # Verify the save worked by checking local file
-        try:
-            if os.path.exists('study_materials.json'):
-                with open('study_materials.json', 'r', encoding='utf-8') as f:
-                    saved_data = json.load(f)
-                    saved_count = len(saved_data.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", []))
-                    print(f"🔍 VERIFICATION: Local file has {saved_count} materials for {subject}")
-            else:
-                print("❌ VERIFICATION: Local file not found after save!")
-        except Exception as e:
-            print(f"❌ VERIFICATION ERROR: {e}")
+        logger.debug("➕ Adding material to: %s/%s/%s", branch, semester, subject)
+        materials_count = _append_material(branch, semester, subject, new_material)
+        logger.debug("📊 Material added. Now %d materials in %s", materials_count, subject)
         
         # Success message
-        text = (
-            f"🎉 **Material Uploaded Successfully!**\n\n"
-            f"👤 **Uploaded by:** {user.first_name}\n"
-            f"🏛️ **Branch:** {branch}\n"
-            f"📅 **Semester:** {semester}\n"
-            f"📚 **Subject:** {subject}\n"
-            f"📄 **Title:** {title}\n"
-            f"🔍 **Keywords:** {', '.join(keywords)}\n\n"
-            f"✅ The material is now available to users."
+        text = _UPLOAD_OK_TMPL.format(
+            user=user.first_name, branch=branch, semester=semester,
+            subject=subject, title=title, keywords=', '.join(keywords)
         )
         
         # Clear upload data
@@ -424,101 +863,153 @@ async def handle_team_upload_text(update: Update, context: ContextTypes.DEFAULT_
         context.user_data.pop("upload_file_name", None)
         context.user_data.pop("upload_file_type", None)
         
-        keyboard = [
-            [InlineKeyboardButton("📤 Upload Another", callback_data="upload_menu")],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_UPLOAD_DONE_KB, parse_mode="Markdown")
         context.user_data['current_state'] = START
         return START
         
     except Exception as e:
-        error_text = (
-            f"❌ **Error:** {str(e)}\n\n"
-            "📝 **Please try again with this format:**\n"
-            "`Branch, Semester, Subject, Title, Keywords`\n\n"
-            "**Example:**\n"
-            "`CSE, 4, DBMS, DBMS Module 3 Notes, dbms module3 normalization`\n\n"
-            "💡 **Tips:**\n"
-            "- Use exact branch names: CSE, ECE, EEE, Mech, Civil\n"
-            "- Semester must be 1-8\n"
-            "- Add multiple keywords for better search"
-        )
+        error_text = _UPLOAD_ERR_TMPL.format(error=e)
         await update.message.reply_text(error_text, parse_mode="Markdown")
         return UPLOAD_DETAILS
     
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
+
+def _fire_and_forget(coro):
+    """Run a coroutine in the background without waiting for it."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Files and follow-up edits go out through one queue per chat: a chat's messages stay in
+# order while different chats send in parallel, and flood-control waits are retried here
+SEND_RETRIES = 3
+_chat_send_queues = {}
+
+async def _chat_send_worker(chat_id, queue):
+    """Run one chat's queued Bot API calls in order, then exit once the queue is empty."""
+    try:
+        while not queue.empty():
+            call, future = queue.get_nowait()
+            for attempt in range(SEND_RETRIES):
+                try:
+                    result = await call()
+                except RetryAfter as e:
+                    if attempt + 1 < SEND_RETRIES:
+                        logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    if not future.done():
+                        future.set_exception(e)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                break
+    finally:
+        del _chat_send_queues[chat_id]
+
+# Document sends get longer timeouts and a cap below the connection pool size, so a few
+# slow sends wait here instead of holding every pooled connection
+DOCUMENT_SEND_LIMIT = 32
+DOCUMENT_SEND_TIMEOUT = 60  # seconds
+_document_send_slots = asyncio.Semaphore(DOCUMENT_SEND_LIMIT)
+
+async def send_document_limited(bot, **kwargs):
+    """bot.send_document, limited to DOCUMENT_SEND_LIMIT sends at a time."""
+    async with _document_send_slots:
+        return await bot.send_document(
+            read_timeout=DOCUMENT_SEND_TIMEOUT, write_timeout=DOCUMENT_SEND_TIMEOUT, **kwargs
+        )
+
+async def send_in_chat_order(chat_id, call):
+    """Queue call() (a coroutine function making one Bot API request) for chat_id and return its result."""
+    queue = _chat_send_queues.get(chat_id)
+    if queue is None:
+        queue = _chat_send_queues[chat_id] = asyncio.Queue()
+        _fire_and_forget(_chat_send_worker(chat_id, queue))
+    future = asyncio.get_running_loop().create_future()
+    queue.put_nowait((call, future))
+    return await future
+
+# Last (text, markup) put on a message by edit_if_changed, so repeated status presses
+# that would show the same thing skip the API call (Telegram rejects them anyway)
+_LAST_EDITS = TTLCache(maxsize=10_000, ttl=600)
+
+async def edit_if_changed(query, text, reply_markup, **kwargs):
+    """query.edit_message_text, skipped when the message already shows text and reply_markup."""
+    message = query.message
+    key = (message.chat_id, message.message_id)
+    # The markup check catches the message having been edited by some other handler since
+    if _LAST_EDITS.get(key) == (text, reply_markup) and message.reply_markup == reply_markup:
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    _LAST_EDITS[key] = (text, reply_markup)
+
+def track_in_background(user, action):
+    """Record a user interaction without waiting on its GitHub save."""
+    _fire_and_forget(asyncio.to_thread(
+        track_user_interaction,
+        user_id=user.id,
+        username=user.username or "No username",
+        first_name=user.first_name or "Unknown",
+        action=action
+    ))
+
+async def _answer_callback(query):
+    """Answer a callback query, logging instead of raising on failure."""
+    try:
+        await query.answer()
+    except Exception as e:
+        logger.warning(f"Could not answer callback query: {e}")
+
+# Pre-"prefix:payload" callback data, still on buttons in older messages.
+# Longest first, since free_download_ is a prefix of free_download_search_
+_LEGACY_CALLBACK_PREFIXES = (
+    "free_download_search_",
+    "free_download_",
+    "verify_download_",
+    "check_status_",
+    "search_result_",
+    "material_",
+    "subject_",
+)
+
+def _split_callback_data(data):
+    """Split callback data into (prefix, payload); old "prefix_payload" data is accepted too.
+
+    Returns (data, "") for data without a payload.
+    """
+    prefix, sep, payload = data.partition(":")
+    if sep:
+        return prefix, payload
+    for legacy in _LEGACY_CALLBACK_PREFIXES:
+        if data.startswith(legacy):
+            return legacy[:-1], data[len(legacy):]
+    return data, ""
+
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Fixed button handler with error handling"""
     try:
         query = update.callback_query
-        await query.answer()
+        # Answer in the background so the handler doesn't wait on that round-trip
+        _fire_and_forget(_answer_callback(query))
         
         data = query.data
         logger.info(f"Button pressed: {data}")
         
-        # Handle ad verification buttons FIRST
-        if data.startswith("verify_download_") or data.startswith("check_status_"):
-            await handle_verification(update, context)
-            return START
-        
-        # Handle free downloads (both browse and search)
-        if data.startswith("free_download"):
-            await handle_free_download(update, context)
-            return START
-        
-        # Handle status display
-        if data == "show_my_status":
-            await show_user_status(update, context)
-            return START
-        
-        # Handle search results - CRITICAL FIX
-        if data.startswith("search_result_"):
-            result_index = int(data.replace("search_result_", ""))
-            logger.info(f"Processing search result: {result_index}")
-            return await show_search_result(update, context, result_index)
-        
-        # Handle material selection from browse
-        if data.startswith("material_"):
-            material_index = int(data.replace("material_", ""))
-            logger.info(f"Processing material selection: {material_index}")
-            return await select_material(update, context, material_index)
-        
-        # Then handle other navigation buttons
-        if data == "browse":
-            return await show_branches(update, context)
-        elif data == "help":
-            return await show_help(update, context)
-        elif data == "search":
-            return await start_search(update, context)
-        elif data == "upload_menu":
-            return await show_upload_menu(update, context)
-        elif data == "donate":
-            return await show_donation_options(update, context)
-        elif data in ["copy_upi", "copy_btc", "donate_upi_qr"]:
-            await handle_donation_buttons(update, context)
-            return START
-        elif data in ["CSE", "ECE", "EEE", "Mech", "Civil"]:
-            context.user_data["branch"] = data
-            return await show_semesters(update, context)
-        elif data.isdigit() and 1 <= int(data) <= 8:
-            context.user_data["semester"] = data
-            return await show_subjects(update, context)
-        elif data.startswith("subject_"):
-            subject = data.replace("subject_", "")
-            context.user_data["subject"] = subject
-            return await show_materials(update, context)
-        elif data == "back_to_start":
-            return await start(update, context)
-        elif data == "back_to_branches":
-            return await show_branches(update, context)
-        elif data == "back_to_semesters":
-            return await show_semesters(update, context)
-        elif data == "back_to_subjects":
-            return await show_subjects(update, context)
-        elif data == "back_to_search":
-            return await show_search_results(update, context)
+        # Exact callback names first, then "prefix:payload" callbacks (see _EXACT_HANDLERS/_PREFIX_HANDLERS)
+        handler = _EXACT_HANDLERS.get(data)
+        if handler:
+            return await handler(update, context)
+        
+        prefix, payload = _split_callback_data(data)
+        handler = _PREFIX_HANDLERS.get(prefix) if payload else None
+        if handler:
+            return await handler(update, context, payload)
         
         # If we get here, it's an unknown button
         logger.warning(f"Unknown button data: {data}")
@@ -526,23 +1017,59 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return await start(update, context)
         
     except Exception as e:
-        logger.error(f"Error in handle_button: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in handle_button: {e}")
         
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text("❌ Error processing button. Please try again.")
         return await start(update, context)
 
+# Button actions that need more than a plain handler call
+def _returns_start(handler):
+    """Wrap a handler that doesn't return a state so the button goes back to START."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        await handler(update, context)
+        return START
+    return wrapper
+
+async def _select_branch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data["branch"] = update.callback_query.data
+    return await show_semesters(update, context)
+
+async def _select_semester(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data["semester"] = update.callback_query.data
+    return await show_subjects(update, context)
+
+async def _select_subject(update: Update, context: ContextTypes.DEFAULT_TYPE, subject: str) -> int:
+    context.user_data["subject"] = subject
+    return await show_materials(update, context)
+
+async def _handle_verification_button(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str) -> int:
+    await handle_verification(update, context)
+    return START
+
+async def _handle_free_download_button(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str) -> int:
+    await handle_free_download(update, context)
+    return START
+
+async def _handle_search_result(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str) -> int:
+    result_index = int(payload)
+    logger.info(f"Processing search result: {result_index}")
+    return await show_search_result(update, context, result_index)
+
+async def _handle_material(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str) -> int:
+    material_index = int(payload)
+    logger.info(f"Processing material selection: {material_index}")
+    return await select_material(update, context, material_index)
+
 # ADD these admin command functions:
 async def ad_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show ad performance statistics"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
-    stats = load_ad_stats()
+    stats = AD_STATS_DATA
     
     text = "📊 **Ad Performance Report**\n\n"
     text += f"💰 **Total Revenue:** ${stats.get('revenue_earned', 0):.2f}\n"
@@ -561,7 +1088,7 @@ async def ad_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def toggle_ads(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Toggle ad system on/off"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
@@ -574,7 +1101,7 @@ async def toggle_ads(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_admin_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the admin upload process with clear instructions."""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.callback_query.edit_message_text("❌ You don't have permission to upload materials.")
         return await start(update, context)
     
@@ -591,28 +1118,25 @@ async def start_admin_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "Click Cancel to go back."
     )
     
-    keyboard = [[InlineKeyboardButton("❌ Cancel Upload", callback_data="back_to_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.callback_query.edit_message_text(text, reply_markup=_ADMIN_UPLOAD_CANCEL_KB, parse_mode="Markdown")
     context.user_data['current_state'] = ADMIN_UPLOAD
     return ADMIN_UPLOAD
 
 async def handle_admin_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle file upload from admin with better feedback."""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ You don't have permission to upload materials.")
         return await start(update, context)
     
-    if update.message.document:
-        file = await update.message.document.get_file()
-        file_id = update.message.document.file_id
-        file_name = update.message.document.file_name
-        file_size = update.message.document.file_size
+    doc = update.message.document
+    if doc:
+        file_id = doc.file_id
+        file_name = doc.file_name
+        file_size = doc.file_size
         
         # Validate file type
-        if not file_name.lower().endswith('.pdf'):
+        if os.path.splitext(file_name)[1].lower() != '.pdf':
             await update.message.reply_text("❌ Please upload PDF files only.")
             return ADMIN_UPLOAD
         
@@ -626,8 +1150,9 @@ async def handle_admin_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data["upload_file_name"] = file_name
         context.user_data["upload_file_type"] = "document"
         
-        # Download file to local storage for backup
+        # Download file to local storage for backup (only once it passed validation)
         try:
+            file = await doc.get_file()
             downloaded_file = await file.download_to_drive(f"{config.PDF_FOLDER}{file_name}")
             logger.info(f"✅ File saved to: {downloaded_file}")
         except Exception as e:
@@ -655,7 +1180,7 @@ async def handle_admin_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle text input during admin upload with detailed validation."""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ You don't have permission to upload materials.")
         return await start(update, context)
     
@@ -665,38 +1190,7 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ADMIN_UPLOAD
     
     try:
-        # Parse the details
-        parts = [part.strip() for part in update.message.text.split(',')]
-        if len(parts) < 5:
-            raise ValueError("❌ Not enough details. Need: Branch, Semester, Subject, Title, Keywords")
-        
-        branch, semester, subject, title = parts[0], parts[1], parts[2], parts[3]
-        keywords = [k.strip().lower() for k in parts[4:]]
-        
-        # Validate branch
-        valid_branches = ["CSE", "ECE", "EEE", "Mech", "Civil"]
-        if branch not in valid_branches:
-            raise ValueError(f"❌ Invalid branch: {branch}. Use: {', '.join(valid_branches)}")
-        
-        # Validate semester
-        if not semester.isdigit() or not (1 <= int(semester) <= 8):
-            raise ValueError("❌ Invalid semester. Use a number between 1-8")
-        
-        # Validate other fields
-        if not subject.strip():
-            raise ValueError("❌ Subject cannot be empty")
-        if not title.strip():
-            raise ValueError("❌ Title cannot be empty")
-        if not keywords:
-            raise ValueError("❌ Please provide at least one keyword")
-        
-        # Create structure if not exists
-        if branch not in STUDY_MATERIALS:
-            STUDY_MATERIALS[branch] = {}
-        if semester not in STUDY_MATERIALS[branch]:
-            STUDY_MATERIALS[branch][semester] = {}
-        if subject not in STUDY_MATERIALS[branch][semester]:
-            STUDY_MATERIALS[branch][semester][subject] = {"materials": []}
+        branch, semester, subject, title, keywords = _parse_upload_details(update.message.text)
         
         # Add material
         new_material = {
@@ -705,20 +1199,12 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "type": context.user_data["upload_file_type"],
             "keywords": keywords
         }
-        
-        STUDY_MATERIALS[branch][semester][subject]["materials"].append(new_material)
-        save_materials(STUDY_MATERIALS)
+        _append_material(branch, semester, subject, new_material)
         
         # Success message
-        text = (
-            f"🎉 **Material Uploaded Successfully!**\n\n"
-            f"🏛️ **Branch:** {branch}\n"
-            f"📅 **Semester:** {semester}\n"
-            f"📚 **Subject:** {subject}\n"
-            f"📄 **Title:** {title}\n"
-            f"🔍 **Keywords:** {', '.join(keywords)}\n"
-            f"🆔 **File ID:** `{context.user_data['upload_file_id']}`\n\n"
-            "✅ The material is now available to users."
+        text = _ADMIN_UPLOAD_OK_TMPL.format(
+            branch=branch, semester=semester, subject=subject, title=title,
+            keywords=', '.join(keywords), file_id=context.user_data['upload_file_id']
         )
         
         # Clear upload data
@@ -726,58 +1212,56 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data.pop("upload_file_name", None)
         context.user_data.pop("upload_file_type", None)
         
-        keyboard = [
-            [InlineKeyboardButton("📤 Upload Another", callback_data="admin_upload")],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_ADMIN_UPLOAD_DONE_KB, parse_mode="Markdown")
         context.user_data['current_state'] = START
         return START
         
     except Exception as e:
-        error_text = (
-            f"❌ **Error:** {str(e)}\n\n"
-            "📝 **Please try again with this format:**\n"
-            "`Branch, Semester, Subject, Title, Keywords`\n\n"
-            "🔸 **Example:**\n"
-            "`CSE, 4, DBMS, DBMS Module 1 Notes, dbms database module1`\n\n"
-            "💡 **Tips:**\n"
-            "- Use exact branch names: CSE, ECE, EEE, Mech, Civil\n"
-            "- Semester must be 1-8\n"
-            "- Add multiple keywords for better search"
-        )
+        error_text = _UPLOAD_ERR_TMPL.format(error=e)
         await update.message.reply_text(error_text, parse_mode="Markdown")
         return ADMIN_UPLOAD
     
 # Access Control System
 def is_admin(user_id):
     """Check if user is full admin"""
-    return user_id in config.ADMIN_IDS
+    return user_id in _ADMIN_IDS
 
 def is_team_member(user_id):
     """Check if user is team member (upload access only)"""
-    return user_id in config.TEAM_MEMBER_IDS or user_id in config.ADMIN_IDS
+    return user_id in _TEAM_IDS
 
 def get_user_role(user_id):
     """Get user role for display"""
-    if is_admin(user_id):
-        return "👑 Admin"
-    elif is_team_member(user_id):
-        return "👥 Team Member" 
-    else:
-        return "👤 User"
+    return _ROLE_LABELS[_lookup_role(user_id)]
+
+_ROLE_LABELS = {"admin": "👑 Admin", "team": "👥 Team Member", "user": "👤 User"}
+
+def _lookup_role(user_id):
+    """Get the role key ("admin", "team" or "user") for a user ID"""
+    if user_id in _ADMIN_IDS:
+        return "admin"
+    elif user_id in _TEAM_IDS:
+        return "team"
+    return "user"
+
+def get_cached_role(context, user_id):
+    """Get the user's role key, cached in user_data for the rest of the session"""
+    role = context.user_data.get('role')
+    if role is None:
+        # User hasn't sent /start yet in this session
+        role = context.user_data['role'] = _lookup_role(user_id)
+    return role
+
+def is_team_member_ctx(context, user_id):
+    """Check upload access using the session's cached role"""
+    return get_cached_role(context, user_id) in ("admin", "team")
 
 # Search functionality
 async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the search process."""
     text = "🔍 **Search Materials**\n\nPlease type what you're looking for:\n\nExamples:\n- `dbms module 1 notes`\n- `operating systems`\n- `cse 4 sem dbms`"
     
-    keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    await update.callback_query.edit_message_text(text, reply_markup=_BACK_TO_START_KB)
     context.user_data['current_state'] = SEARCH_RESULTS
     return SEARCH_RESULTS
 
@@ -785,31 +1269,14 @@ async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     """Handle search query."""
     user = update.effective_user
     # Track search action
-    try:
-        from user_tracking import track_user_interaction
-        track_user_interaction(
-            user_id=user.id,
-            username=user.username or "No username", 
-            first_name=user.first_name or "Unknown",
-            action="search"
-        )
-    except Exception as e:
-        print(f"⚠️ Could not track search: {e}")
+    track_in_background(user, "search")
     
     query = update.message.text
-    results = search_materials(query)
+    results = search_materials(query, limit=SEARCH_PAGE_SIZE)
     
     if not results:
         text = f"❌ No results found for: `{query}`\n\nTry different keywords or browse by branch."
-        keyboard = [
-            [
-                InlineKeyboardButton("🔍 Search Again", callback_data="search"),
-                InlineKeyboardButton("📂 Browse by Branch", callback_data="browse"),
-            ],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_NO_RESULTS_KB, parse_mode="Markdown")
         context.user_data['current_state'] = START
         return START
     
@@ -824,18 +1291,20 @@ async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE
     results = context.user_data.get("search_results", [])
     query = context.user_data.get("search_query", "")
     
-    text = f"🔍 Search results for: `{query}`\n\n**Found {len(results)} results:**\n\n"
-    
-    keyboard = []
-    for i, result in enumerate(results[:10]):  # Show first 10 results
-        material = result["material"]
-        btn_text = f"{i+1}. {material['title']} ({result['branch']} Sem {result['semester']})"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"search_result_{i}")])
+    # Searches stop collecting at SEARCH_PAGE_SIZE, so a full page means there may be more
+    if len(results) >= SEARCH_PAGE_SIZE:
+        text = f"🔍 Search results for: `{query}`\n\n**Top {SEARCH_PAGE_SIZE} results:**\n\n"
+    else:
+        text = f"🔍 Search results for: `{query}`\n\n**Found {len(results)} results:**\n\n"
     
-    keyboard.append([
-        InlineKeyboardButton("🔍 New Search", callback_data="search"),
-        InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
-    ])
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{i+1}. {result['material']['title']} ({result['branch']} Sem {result['semester']})",
+            callback_data=f"search_result:{i}"
+        )]
+        for i, result in enumerate(results[:SEARCH_PAGE_SIZE])
+    ]
+    keyboard.append(_SEARCH_RESULTS_FOOTER)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -851,7 +1320,6 @@ async def show_search_result(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Fixed search result handler"""
     try:
         query = update.callback_query
-        await query.answer()
         
         logger.info(f"show_search_result called with index: {result_index}")
         
@@ -872,31 +1340,18 @@ async def show_search_result(update: Update, context: ContextTypes.DEFAULT_TYPE,
         context.user_data["semester"] = result["semester"] 
         context.user_data["subject"] = result["subject"]
         
-        # Find material index in actual database
-        materials = STUDY_MATERIALS.get(result["branch"], {}).get(result["semester"], {}).get(result["subject"], {}).get("materials", [])
-        logger.info(f"Found {len(materials)} materials in database")
-        
-        material_index = -1
-        for idx, mat in enumerate(materials):
-            if mat.get("title") == material.get("title"):
-                material_index = idx
-                break
+        # Search results carry their index in the database
+        material_index = result["material_index"]
         
         logger.info(f"Material index in database: {material_index}")
         
-        if material_index == -1:
-            await query.edit_message_text("❌ Material not found in database.")
-            return await start(update, context)
-        
         # Use ad verification system
         return await select_material(update, context, material_index)
         
     except Exception as e:
-        logger.error(f"Error in show_search_result: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in show_search_result: {e}")
         
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text("❌ Error loading search result. Please try again.")
         return await start(update, context)
 
@@ -905,23 +1360,7 @@ async def show_branches(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     """Show available branches."""
     text = "🎓 Please select your branch:"
     
-    keyboard = [
-        [
-            InlineKeyboardButton("💻 CSE", callback_data="CSE"),
-            InlineKeyboardButton("📡 ECE", callback_data="ECE"),
-        ],
-        [
-            InlineKeyboardButton("⚡ EEE", callback_data="EEE"),
-            InlineKeyboardButton("🔧 Mech", callback_data="Mech"),
-        ],
-        [
-            InlineKeyboardButton("🏗️ Civil", callback_data="Civil"),
-            InlineKeyboardButton("🔙 Back", callback_data="back_to_start"),
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    await update.callback_query.edit_message_text(text, reply_markup=_BRANCHES_KB)
     context.user_data['current_state'] = BRANCH_SELECTION
     return BRANCH_SELECTION
 
@@ -930,22 +1369,7 @@ async def show_semesters(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     branch = context.user_data.get("branch", "Unknown")
     text = f"📅 Please select your semester for {branch}:"
     
-    keyboard = []
-    for i in range(0, 8, 2):
-        row = []
-        if i+1 <= 8:
-            row.append(InlineKeyboardButton(f"Sem {i+1}", callback_data=str(i+1)))
-        if i+2 <= 8:
-            row.append(InlineKeyboardButton(f"Sem {i+2}", callback_data=str(i+2)))
-        keyboard.append(row)
-    
-    keyboard.append([
-        InlineKeyboardButton("🔙 Back to Branches", callback_data="back_to_branches"),
-        InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
-    ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    await update.callback_query.edit_message_text(text, reply_markup=_SEMESTERS_KB)
     context.user_data['current_state'] = SEMESTER_SELECTION
     return SEMESTER_SELECTION
 
@@ -974,11 +1398,7 @@ async def show_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         ]
     else:
         text = f"📚 Available subjects for {branch} Semester {semester}:"
-        keyboard = []
-        
-        for subject in subjects.keys():
-            keyboard.append([InlineKeyboardButton(f"📖 {subject}", callback_data=f"subject_{subject}")])
-        
+        keyboard = [[InlineKeyboardButton(f"📖 {subject}", callback_data=f"subject:{subject}")] for subject in subjects]
         keyboard.append([
             InlineKeyboardButton("🔙 Back to Semesters", callback_data="back_to_semesters"),
             InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
@@ -995,7 +1415,7 @@ async def show_materials(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     semester = context.user_data.get("semester", "Unknown")
     subject = context.user_data.get("subject", "Unknown")
     
-    materials = STUDY_MATERIALS.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", [])
+    materials = MATERIALS_INDEX.get((branch, semester, subject), ())
     
     if not materials:
         text = f"❌ No materials available for {branch} Semester {semester} - {subject}."
@@ -1007,11 +1427,10 @@ async def show_materials(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ]
     else:
         text = f"📚 Available materials for {branch} Sem {semester} - {subject}:"
-        keyboard = []
-        
-        for i, material in enumerate(materials):
-            keyboard.append([InlineKeyboardButton(f"📄 {material['title']}", callback_data=f"material_{i}")])
-        
+        keyboard = [
+            [InlineKeyboardButton(f"📄 {material['title']}", callback_data=f"material:{i}")]
+            for i, material in enumerate(materials)
+        ]
         keyboard.append([
             InlineKeyboardButton("🔙 Back to Subjects", callback_data="back_to_subjects"),
             InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start"),
@@ -1024,85 +1443,54 @@ async def show_materials(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 # Ad Verification System
-class AdVerificationSystem:
-    def __init__(self):
-        self.user_sessions = {}
-        self.ad_clicks = {}
-    
-    def generate_verification_token(self, user_id, material_info):
-        """Generate a unique verification token"""
-        token = f"verify_{user_id}_{int(time.time())}_{random.randint(1000, 9999)}"
-        
-        # Store session information
-        self.user_sessions[token] = {
-            'user_id': user_id,
-            'material_info': material_info,
-            'created_at': time.time(),
-            'ad_clicked': False,
-            'wait_start': None,
-            'completed': False
-        }
-        
-        return token
-    
-    def verify_ad_click(self, token):
-        """Mark ad as clicked and start wait timer"""
-        if token in self.user_sessions:
-            self.user_sessions[token]['ad_clicked'] = True
-            self.user_sessions[token]['wait_start'] = time.time()
-            return True
-        return False
-    
-    def check_verification_status(self, token):
-        """Check if user can download file"""
-        if token not in self.user_sessions:
-            return False, "Invalid token"
-        
-        session = self.user_sessions[token]
-        
-        if not session['ad_clicked']:
-            return False, "Ad not clicked"
-        
-        if session['completed']:
-            return True, "Already verified"
-        
-        # Check if wait time has passed
-        if session['wait_start']:
-            elapsed = time.time() - session['wait_start']
-            if elapsed >= config.WAIT_TIME_SECONDS:
-                session['completed'] = True
-                return True, "Verification complete"
-            else:
-                remaining = config.WAIT_TIME_SECONDS - int(elapsed)
-                return False, f"Wait {remaining} more seconds"
-        
-        return False, "Verification in progress"
-    
-    def cleanup_old_sessions(self):
-        """Clean up sessions older than 1 hour"""
-        current_time = time.time()
-        expired_tokens = []
-        
-        for token, session in self.user_sessions.items():
-            if current_time - session['created_at'] > 3600:  # 1 hour
-                expired_tokens.append(token)
-        
-        for token in expired_tokens:
-            del self.user_sessions[token]
-
-# Initialize ad verification system
-ad_verification = AdVerificationSystem()
+@dataclass(slots=True)
+class VerifSession:
+    """One pending ad verification, keyed by its token in user_sessions"""
+    user_id: int
+    material_info: dict
+    created_at: float
+    ad_clicked: bool = False
+    wait_start: float | None = None
+    completed: bool = False
+
+SESSION_CACHE_SIZE = 100_000
+SESSION_TTL_SECONDS = 3600  # 1 hour
+STATUS_CACHE_SECONDS = 2  # get_user_status results are reused within this window
 
 # Fixed Smart Ad System with 10-hour free download reset
 class SmartAdSystem:
     def __init__(self):
-        self.user_sessions = {}
-        self.user_tokens = {}
+        # Sessions expire an hour after creation, tokens once their duration is up.
+        # Tokens are earned, so they are never evicted for space - only expiry drops
+        # them, which bounds the cache by the users who watched an ad within the window
+        self.user_sessions = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_TTL_SECONDS)
+        self.user_tokens = TTLCache(maxsize=math.inf, ttl=config.TOKEN_DURATION_HOURS * 3600)
         self.user_stats = {}
+        self.dirty_users = set()  # changed since the last stats flush
+        # user_id -> (time bucket, status) for get_user_status; entries outlive
+        # their bucket only briefly, so the cache holds recently active users only
+        self._status_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=STATUS_CACHE_SECONDS)
+    
+    def mark_changed(self, user_id):
+        """Queue the user's data for saving and drop any cached status"""
+        self.dirty_users.add(user_id)
+        _stats_dirty.set()
+        self._status_cache.pop(user_id, None)
+    
+    def find_user_data(self, user_id):
+        """Get user data from memory or the stats database, None for unknown users"""
+        data = self.user_stats.get(user_id)
+        if data is None:
+            data = load_user_row(user_id)
+            if data is not None:
+                self.user_stats[user_id] = data
+        return data
     
     def get_user_data(self, user_id):
         """Get or create user data with proper 10-hour reset"""
-        if user_id not in self.user_stats:
+        if self.find_user_data(user_id) is None:
+            self.dirty_users.add(user_id)
+            _stats_dirty.set()
             self.user_stats[user_id] = {
                 'free_downloads_used': 0,
                 'total_downloads': 0,
@@ -1113,42 +1501,39 @@ class SmartAdSystem:
             }
         return self.user_stats[user_id]
     
-    def reset_free_downloads_if_needed(self, user_id):
+    def reset_free_downloads_if_needed(self, user_id, user_data=None, current_time=None):
         """Reset free downloads if 10 hours have passed - FIXED LOGIC"""
-        user_data = self.get_user_data(user_id)
-        current_time = time.time()
-        
-        # Check if reset time has passed
-        if current_time >= user_data['free_downloads_reset_time']:
-            # Reset free downloads and set new reset time (10 hours from now)
-            user_data['free_downloads_used'] = 0
-            user_data['free_downloads_reset_time'] = current_time + (config.FREE_DOWNLOAD_RESET_HOURS * 3600)
-            user_data['last_reset'] = current_time
-            logger.info(f"Reset free downloads for user {user_id}")
-            return True
-        return False
+        if user_data is None:
+            user_data = self.get_user_data(user_id)
+        if current_time is None:
+            current_time = time.time()
+        
+        # Common case: reset time not reached yet
+        if current_time < user_data.get('free_downloads_reset_time', 0):
+            return False
+        
+        # Reset free downloads and set new reset time (10 hours from now)
+        user_data['free_downloads_used'] = 0
+        user_data['free_downloads_reset_time'] = current_time + (config.FREE_DOWNLOAD_RESET_HOURS * 3600)
+        user_data['last_reset'] = current_time
+        self.mark_changed(user_id)
+        logger.info(f"Reset free downloads for user {user_id}")
+        return True
     
     def can_download_free(self, user_id):
         """Check if user can download for free (resets every 10 hours) - FIXED"""
         user_data = self.get_user_data(user_id)
         
         # Always check if we need to reset free downloads
-        self.reset_free_downloads_if_needed(user_id)
+        self.reset_free_downloads_if_needed(user_id, user_data)
         
         # User can download free if they haven't used all free downloads
         return user_data['free_downloads_used'] < config.FREE_DOWNLOADS_ALLOWED
     
     def has_valid_token(self, user_id):
         """Check if user has valid token"""
-        if user_id in self.user_tokens:
-            token_data = self.user_tokens[user_id]
-            if time.time() < token_data['expires_at']:
-                return True
-            else:
-                # Token expired, remove it
-                del self.user_tokens[user_id]
-                logger.info(f"Token expired for user {user_id}")
-        return False
+        # Expired tokens have already dropped out of the cache
+        return user_id in self.user_tokens
     
     def use_free_download(self, user_id):
         """Use one free download and return new count"""
@@ -1158,6 +1543,7 @@ class SmartAdSystem:
         if user_data['free_downloads_used'] < config.FREE_DOWNLOADS_ALLOWED:
             user_data['free_downloads_used'] += 1
             user_data['total_downloads'] += 1
+            self.mark_changed(user_id)
             logger.info(f"Free download used by {user_id}. Now {user_data['free_downloads_used']}/{config.FREE_DOWNLOADS_ALLOWED}")
             return user_data['free_downloads_used']
         else:
@@ -1174,26 +1560,39 @@ class SmartAdSystem:
         user_data = self.get_user_data(user_id)
         user_data['tokens_earned'] += 1
         user_data['last_ad_watch'] = current_time
+        self.mark_changed(user_id)
         logger.info(f"Granted {config.TOKEN_DURATION_HOURS}-hour token to user {user_id}")
     
     def get_user_status(self, user_id):
+        """Get user's download status, reusing the last result for up to STATUS_CACHE_SECONDS"""
+        stamp = int(time.time()) // STATUS_CACHE_SECONDS
+        cached = self._status_cache.get(user_id)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        
+        status = self._compute_user_status(user_id)
+        self._status_cache[user_id] = (stamp, status)
+        return status
+    
+    def _compute_user_status(self, user_id):
         """Get user's download status with time remaining - FIXED"""
         user_data = self.get_user_data(user_id)
+        current_time = time.time()
         
         # Check if free downloads need reset (IMPORTANT: Call this every time)
-        self.reset_free_downloads_if_needed(user_id)
+        self.reset_free_downloads_if_needed(user_id, user_data, current_time)
         
         free_remaining = config.FREE_DOWNLOADS_ALLOWED - user_data['free_downloads_used']
-        has_token = self.has_valid_token(user_id)
+        token_data = self.user_tokens.get(user_id)  # None once expired
+        has_token = token_data is not None
         
         # Calculate time until free downloads reset
-        current_time = time.time()
         reset_time_remaining = user_data['free_downloads_reset_time'] - current_time
         hours_until_reset = max(0, reset_time_remaining // 3600)
         minutes_until_reset = max(0, (reset_time_remaining % 3600) // 60)
         
         if has_token:
-            token_expiry = self.user_tokens[user_id]['expires_at']
+            token_expiry = token_data['expires_at']
             token_time_remaining = token_expiry - current_time
             token_hours_left = max(0, token_time_remaining // 3600)
             token_minutes_left = max(0, (token_time_remaining % 3600) // 60)
@@ -1229,24 +1628,19 @@ class SmartAdSystem:
     
     def generate_verification_token(self, user_id, material_info):
         """Generate verification token for ad watching"""
-        token = f"verify_{user_id}_{int(time.time())}_{random.randint(1000, 9999)}"
-        
-        self.user_sessions[token] = {
-            'user_id': user_id,
-            'material_info': material_info,
-            'created_at': time.time(),
-            'ad_clicked': False,
-            'wait_start': None,
-            'completed': False
-        }
+        # Unguessable; the session itself records who it belongs to
+        token = "v_" + secrets.token_urlsafe(8)
+        
+        self.user_sessions[token] = VerifSession(user_id, material_info, time.time())
         
         return token
     
     def verify_ad_click(self, token):
         """Mark ad as clicked and start wait timer"""
-        if token in self.user_sessions:
-            self.user_sessions[token]['ad_clicked'] = True
-            self.user_sessions[token]['wait_start'] = time.time()
+        session = self.user_sessions.get(token)
+        if session is not None:
+            session.ad_clicked = True
+            session.wait_start = time.time()
             logger.info(f"Ad clicked for token {token}")
             return True
         return False
@@ -1258,20 +1652,20 @@ class SmartAdSystem:
         
         session = self.user_sessions[token]
         
-        if not session['ad_clicked']:
+        if not session.ad_clicked:
             return False, "Please click the ad link first"
         
-        if session['completed']:
+        if session.completed:
             return True, "Already verified"
         
         # Check if wait time has passed
-        if session['wait_start']:
-            elapsed = time.time() - session['wait_start']
+        if session.wait_start:
+            elapsed = time.time() - session.wait_start
             if elapsed >= config.WAIT_TIME_SECONDS:
-                session['completed'] = True
+                session.completed = True
                 
                 # Grant token to user
-                self.grant_token(session['user_id'])
+                self.grant_token(session.user_id)
                 
                 return True, f"Verification complete! 🎉 You now have {config.TOKEN_DURATION_HOURS} hours of unlimited downloads!"
             else:
@@ -1279,29 +1673,21 @@ class SmartAdSystem:
                 return False, f"Please wait {remaining} more seconds with the ad page open"
         
         return False, "Verification in progress"
-    
-    def cleanup_old_sessions(self):
-        """Clean up old sessions"""
-        current_time = time.time()
-        expired_tokens = []
-        
-        for token, session in self.user_sessions.items():
-            if current_time - session['created_at'] > 3600:  # 1 hour
-                expired_tokens.append(token)
-        
-        for token in expired_tokens:
-            del self.user_sessions[token]
 
 # Initialize smart ad system
 smart_ad_system = SmartAdSystem()
+# Verification used to have its own session store; both names now share one
+ad_verification = smart_ad_system
+
+# Save/Load user stats
+# Per-user rows in SQLite, so saving one user doesn't rewrite everyone
+USER_STATS_DB = 'stats.db'
 
-# Save/Load user stats to file
-# Fixed Smart Ad System initialization
 def load_user_stats():
-    """Load user statistics from file with error handling"""
+    """Load user statistics from the legacy JSON file with error handling"""
     try:
-        with open('user_stats.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open('user_stats.json', 'rb') as f:
+            data = _json_loads(f.read())
             # Convert string keys back to integers for user_id
             stats = {}
             for k, v in data.items():
@@ -1314,20 +1700,108 @@ def load_user_stats():
         logger.info(f"Creating new user stats file: {e}")
         return {}
 
-def save_user_stats():
-    """Save user statistics to file with error handling"""
-    try:
-        with open('user_stats.json', 'w', encoding='utf-8') as f:
-            # Convert user_id to string for JSON
-            data = {str(k): v for k, v in smart_ad_system.user_stats.items()}
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        logger.info("User stats saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving user stats: {e}")
+def _open_stats_db():
+    """Open the user stats database, importing user_stats.json the first time."""
+    db = sqlite3.connect(USER_STATS_DB, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS user_stats (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+    
+    if db.execute("SELECT 1 FROM user_stats LIMIT 1").fetchone() is None:
+        rows = [(k, _json_dumps(v)) for k, v in load_user_stats().items() if isinstance(k, int)]
+        db.executemany("INSERT OR REPLACE INTO user_stats (user_id, data) VALUES (?, ?)", rows)
+        logger.info(f"Imported {len(rows)} users from user_stats.json")
+    
+    db.commit()
+    return db
+
+# Writes come from worker threads and share this connection under the lock
+_stats_db = _open_stats_db()
+_stats_db_lock = threading.Lock()
+
+# Point reads on the event loop get their own connection; under WAL they never
+# wait for a write in progress, so no lock is taken
+_stats_read_db = sqlite3.connect(USER_STATS_DB, check_same_thread=False)
+_stats_read_db.execute("PRAGMA query_only = ON")
+
+def load_user_row(user_id):
+    """Read one user's stats from the database, None if they have none."""
+    row = _stats_read_db.execute("SELECT data FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+    return _json_loads(row[0]) if row else None
+
+def save_user_rows(rows):
+    """Upsert (user_id, json data) rows (run in a worker thread)."""
+    with _stats_db_lock:
+        _stats_db.executemany("INSERT OR REPLACE INTO user_stats (user_id, data) VALUES (?, ?)", rows)
+        _stats_db.commit()
+
+def _take_dirty_user_rows():
+    """Serialize the changed users and reset the dirty set."""
+    dirty = smart_ad_system.dirty_users
+    smart_ad_system.dirty_users = set()
+    return [(uid, _json_dumps(smart_ad_system.user_stats[uid])) for uid in dirty]
+
+async def save_user(user_id):
+    """Save one user's stats right away."""
+    smart_ad_system.dirty_users.discard(user_id)
+    row = (user_id, _json_dumps(smart_ad_system.user_stats[user_id]))
+    await asyncio.to_thread(save_user_rows, [row])
+
+with _stats_db_lock:
+    _user_count = _stats_db.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0]
+logger.info(f"User stats database has {_user_count} users")
+
+def _write_bytes(path, data):
+    """Write a serialized stats file (run in a worker thread)."""
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# Stats live in memory; changes are marked dirty and _stats_flush_worker writes them out
+STATS_FLUSH_INTERVAL = 2  # seconds; changes within this window go out in one write
+_stats_dirty = asyncio.Event()
+_ad_stats_dirty = False
+_stats_flush_task = None
+
+def mark_ad_stats_dirty():
+    """Queue AD_STATS_DATA for the next stats flush."""
+    global _ad_stats_dirty
+    _ad_stats_dirty = True
+    _stats_dirty.set()
+
+async def flush_stats():
+    """Write any dirty stats without blocking the event loop."""
+    global _ad_stats_dirty
+    _stats_dirty.clear()
+    # Serialize here so the worker thread never sees the dicts change mid-dump
+    if smart_ad_system.dirty_users:
+        try:
+            await asyncio.to_thread(save_user_rows, _take_dirty_user_rows())
+        except Exception as e:
+            logger.error(f"Error saving user stats: {e}")
+    if _ad_stats_dirty:
+        _ad_stats_dirty = False
+        try:
+            data = _json_dumps_file(AD_STATS_DATA)
+            await asyncio.to_thread(_write_bytes, 'ad_stats.json', data)
+        except Exception as e:
+            logger.error(f"Error saving ad stats: {e}")
+
+async def _stats_flush_worker():
+    """Flush stats in the background whenever they are marked dirty."""
+    while True:
+        await _stats_dirty.wait()
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        await flush_stats()
+
+_user_stats_task = None
 
-# Load user stats at startup
-smart_ad_system.user_stats = load_user_stats()
-logger.info(f"Loaded user stats for {len(smart_ad_system.user_stats)} users")
+async def _user_stats_flush_worker():
+    """Upload the tracked user stats every USER_STATS_FLUSH_INTERVAL seconds if they changed."""
+    while True:
+        await asyncio.sleep(USER_STATS_FLUSH_INTERVAL)
+        # A pending materials save commits the user stats too
+        if not _materials_dirty.is_set():
+            async with _user_stats_lock:
+                await asyncio.to_thread(flush_user_stats)
 
 
 async def debug_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1335,30 +1809,19 @@ async def debug_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_status = smart_ad_system.get_user_status(user_id)
     
-    debug_text = f"""
-🔧 **Debug Information - User {user_id}**
-
-**Current Status:**
-- Free Downloads Used: {user_status['free_remaining']}/{user_status['free_total']}
-- Status: {user_status['status']}
-- Total Downloads: {user_status['total_downloads']}
-- Reset In: {user_status['hours_until_reset']}h {user_status['minutes_until_reset']}m
-
-**System State:**
-- AD_VERIFICATION_ENABLED: {config.AD_VERIFICATION_ENABLED}
-- FREE_DOWNLOADS_ALLOWED: {config.FREE_DOWNLOADS_ALLOWED}
-- TOKEN_DURATION_HOURS: {config.TOKEN_DURATION_HOURS}
-"""
+    debug_text = _DEBUG_TMPL.format(user_id=user_id, ads_enabled=config.AD_VERIFICATION_ENABLED, **user_status)
     
     await update.message.reply_text(debug_text, parse_mode="Markdown")
 
 async def reset_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset user's download count (for testing)"""
     user_id = update.effective_user.id
-    if user_id in smart_ad_system.user_stats:
-        smart_ad_system.user_stats[user_id]['free_downloads_used'] = 0
-        smart_ad_system.user_stats[user_id]['free_downloads_reset_time'] = time.time() + (10 * 3600)
-        save_user_stats()
+    user_data = smart_ad_system.find_user_data(user_id)
+    if user_data is not None:
+        user_data['free_downloads_used'] = 0
+        user_data['free_downloads_reset_time'] = time.time() + (10 * 3600)
+        smart_ad_system.mark_changed(user_id)
+        await save_user(user_id)
         await update.message.reply_text("✅ User stats reset for testing")
     else:
         await update.message.reply_text("❌ User not found in stats")
@@ -1368,8 +1831,8 @@ async def reset_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def load_ad_stats():
     """Load advertisement statistics"""
     try:
-        with open('ad_stats.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open('ad_stats.json', 'rb') as f:
+            return _json_loads(f.read())
     except (FileNotFoundError, json.JSONDecodeError):
         return {
             "total_impressions": 0,
@@ -1379,16 +1842,43 @@ def load_ad_stats():
         }
 
 def save_ad_stats(stats):
-    """Save advertisement statistics"""
-    try:
-        with open('ad_stats.json', 'w', encoding='utf-8') as f:
-            json.dump(stats, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"Error saving ad stats: {e}")
+    """Save advertisement statistics (written out by the next stats flush)"""
+    if stats is not AD_STATS_DATA:
+        AD_STATS_DATA.clear()
+        AD_STATS_DATA.update(stats)
+    mark_ad_stats_dirty()
+
+# Loaded once; AD_STATS is taken by the conversation state of the same name
+AD_STATS_DATA = load_ad_stats()
+
+# _AD_VERIF_TMPL with each ad's sponsor text already filled in (braces escaped for str.format)
+_AD_VERIF_TMPLS = {
+    ad['ad_id']: _AD_VERIF_TMPL.replace("{sponsor}", ad['text'].replace("{", "{{").replace("}", "}}"))
+    for ad in config.ADS
+}
+
+_AD_BY_ID = {ad['ad_id']: ad for ad in config.ADS}
+
+# Ads rotate through a shuffled cycle holding each ad "weight" times (default 1),
+# so impressions split exactly in proportion over every pass
+_AD_CYCLE = [ad for ad in config.ADS for _ in range(int(ad.get("weight", 1)))]
+random.shuffle(_AD_CYCLE)
+_AD_ROTATION = itertools.cycle(_AD_CYCLE)
+
+def pick_ad():
+    """Pick the next ad to show, weighted by config.ADS weights."""
+    return next(_AD_ROTATION)
+
+def record_ad_impression(ad_id):
+    """Count an ad being shown"""
+    stats = AD_STATS_DATA
+    stats['total_impressions'] = stats.get('total_impressions', 0) + 1
+    stats['ad_clicks'].setdefault(ad_id, {'clicks': 0, 'conversions': 0})
+    mark_ad_stats_dirty()
 
 def record_ad_conversion(user_id, ad_id, amount=0.02):
     """Record successful ad conversion"""
-    stats = load_ad_stats()
+    stats = AD_STATS_DATA
     
     stats['conversions'] = stats.get('conversions', 0) + 1
     stats['revenue_earned'] = stats.get('revenue_earned', 0.0) + amount
@@ -1398,96 +1888,17 @@ def record_ad_conversion(user_id, ad_id, amount=0.02):
     
     stats['ad_clicks'][ad_id]['conversions'] = stats['ad_clicks'][ad_id].get('conversions', 0) + 1
     
-    save_ad_stats(stats)
+    mark_ad_stats_dirty()
     logger.info(f"Ad conversion recorded: user {user_id}, ad {ad_id}")
 
-async def show_ad_verification(update: Update, context: ContextTypes.DEFAULT_TYPE, material_index: int):
-    """Show ad verification required before download"""
-    query = update.callback_query
-    await query.answer()
-    
-    branch = context.user_data.get("branch")
-    semester = context.user_data.get("semester")
-    subject = context.user_data.get("subject")
-    
-    materials = STUDY_MATERIALS.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", [])
-    
-    if material_index >= len(materials):
-        await query.edit_message_text("❌ Material not found.")
-        return await start(update, context)
-    
-    material = materials[material_index]
-    
-    # Get random ad
-    ad = random.choice(config.ADS)
-    user_id = update.effective_user.id
-    
-    # Generate verification token
-    material_info = {
-        'branch': branch,
-        'semester': semester,
-        'subject': subject,
-        'material_index': material_index,
-        'material_title': material['title']
-    }
-    
-    verification_token = ad_verification.generate_verification_token(user_id, material_info)
-    
-    # Create tracking URL with user ID and token
-    tracking_url = ad['tracking_url'].format(user_id=user_id)
-    final_url = f"{tracking_url}&token={verification_token}"
-    
-    # Store ad info in context for later verification
-    context.user_data['current_verification'] = {
-        'token': verification_token,
-        'ad_id': ad['ad_id'],
-        'material_index': material_index
-    }
-    
-    text = (
-        f"📢 **Ad Verification Required**\n\n"
-        f"To download **{material['title']}**, please:\n\n"
-        f"1. 🔗 **Click the ad link below**\n"
-        f"2. ⏳ **Wait for {config.WAIT_TIME_SECONDS} seconds**\n"
-        f"3. ✅ **Return here and click 'Verify & Download'**\n\n"
-        f"**Ad Sponsor:** {ad['text']}\n\n"
-        f"This helps us keep the bot free for everyone! 🙏"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("🔗 Click Ad Link (Required)", url=final_url)],
-        [InlineKeyboardButton("✅ Verify & Download", callback_data=f"verify_download_{verification_token}")],
-        [InlineKeyboardButton("🔄 Check Status", callback_data=f"check_status_{verification_token}")],
-        [InlineKeyboardButton("❌ Cancel Download", callback_data="back_to_subjects")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
-    
-    # Track ad impression
-    stats = load_ad_stats()
-    stats['total_impressions'] += 1
-    if ad['ad_id'] not in stats['ad_clicks']:
-        stats['ad_clicks'][ad['ad_id']] = {'clicks': 0, 'conversions': 0}
-    save_ad_stats(stats)
-
 async def handle_verification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle verification button clicks"""
     query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    
-    if data.startswith("verify_download_"):
-        token = data.replace("verify_download_", "")
-        await process_download_verification(update, context, token)
-    
-    elif data.startswith("check_status_"):
-        token = data.replace("check_status_", "")
-        await check_verification_status(update, context, token)
     
-    elif data == "show_my_status":
-        await show_user_status(update, context)
+    prefix, payload = _split_callback_data(query.data)
+    handler = _VERIFICATION_HANDLERS.get(prefix)
+    if handler:
+        await handler(update, context, payload)
 
 async def process_download_verification(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str):
     """Process download after ad verification"""
@@ -1511,7 +1922,7 @@ async def process_download_verification(update: Update, context: ContextTypes.DE
             text = f"❌ **Action Required**\n\n{message}\n\nPlease click the ad link first!"
         
         keyboard = [
-            [InlineKeyboardButton("🔄 Check Again", callback_data=f"verify_download_{token}")],
+            [InlineKeyboardButton("🔄 Check Again", callback_data=f"verify_download:{token}")],
             [InlineKeyboardButton("📊 My Status", callback_data="show_my_status")],
             [InlineKeyboardButton("❌ Cancel", callback_data="back_to_subjects")]
         ]
@@ -1522,14 +1933,14 @@ async def process_download_verification(update: Update, context: ContextTypes.DE
     
     # Verification successful - send the file
     session = smart_ad_system.user_sessions[token]
-    material_info = session['material_info']
+    material_info = session.material_info
     
     branch = material_info['branch']
     semester = material_info['semester']
     subject = material_info['subject']
     material_index = material_info['material_index']
     
-    materials = STUDY_MATERIALS.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", [])
+    materials = MATERIALS_INDEX.get((branch, semester, subject), ())
     material = materials[material_index]
     file_id = material.get("file_id")
     
@@ -1541,73 +1952,69 @@ async def process_download_verification(update: Update, context: ContextTypes.DE
     ad_id = context.user_data.get('current_verification', {}).get('ad_id', 'unknown')
     record_ad_conversion(update.effective_user.id, ad_id)
     
-    # Send the file
-    try:
-        user_status = smart_ad_system.get_user_status(update.effective_user.id)
-        
-        caption = (
-            f"✅ **Download Ready!**\n\n"
-            f"📚 {material['title']}\n"
-            f"🏛️ Branch: {branch}\n"
-            f"📅 Semester: {semester}\n"
-            f"📖 Subject: {subject}\n\n"
-        )
-        
-        if user_status['status'] == 'token_active':
-            caption += f"🎉 **{config.TOKEN_DURATION_HOURS}-Hour Token Active!**\nUnlimited downloads for {user_status['token_hours_left']} hours!"
-        
-        await context.bot.send_document(
-            chat_id=query.message.chat_id,
+    user_status = smart_ad_system.get_user_status(update.effective_user.id)
+    
+    caption = (
+        f"✅ **Download Ready!**\n\n"
+        f"📚 {material['title']}\n"
+        f"🏛️ Branch: {branch}\n"
+        f"📅 Semester: {semester}\n"
+        f"📖 Subject: {subject}\n\n"
+    )
+    
+    if user_status['status'] == 'token_active':
+        caption += f"🎉 **{config.TOKEN_DURATION_HOURS}-Hour Token Active!**\nUnlimited downloads for {user_status['token_hours_left']} hours!"
+    
+    # Success message
+    if "token granted" in message:
+        text = f"🎉 **Success!**\n\n{message}\n\n**{material['title']}** has been sent!\n\nEnjoy unlimited downloads for {config.TOKEN_DURATION_HOURS} hours! 🚀"
+    else:
+        text = f"✅ **Download Complete!**\n\n**{material['title']}** has been sent!"
+    
+    # Send the file and show the success message at the same time; the message
+    # is replaced with an error if the send fails
+    chat_id = query.message.chat_id
+    send_result, edit_result = await asyncio.gather(
+        send_in_chat_order(chat_id, lambda: send_document_limited(
+            context.bot,
+            chat_id=chat_id,
             document=file_id,
             caption=caption,
             filename=f"{material['title']}.pdf"
-        )
-        
-        # Success message
-        if "token granted" in message:
-            text = f"🎉 **Success!**\n\n{message}\n\n**{material['title']}** has been sent!\n\nEnjoy unlimited downloads for {config.TOKEN_DURATION_HOURS} hours! 🚀"
-        else:
-            text = f"✅ **Download Complete!**\n\n**{material['title']}** has been sent!"
-        
-    except Exception as e:
-        logger.error(f"Error sending file: {e}")
-        text = f"❌ Error sending file. Please try again or contact admin."
-    
-    keyboard = [
-        [InlineKeyboardButton("📚 More Materials", callback_data="back_to_subjects")],
-        [InlineKeyboardButton("📊 My Status", callback_data="show_my_status")],
-        [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        )),
+        query.edit_message_text(text, reply_markup=_VERIFIED_DOWNLOAD_KB, parse_mode="Markdown"),
+        return_exceptions=True,
+    )
     
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    if isinstance(send_result, Exception):
+        logger.error(f"Error sending file: {send_result}")
+        text = f"❌ Error sending file. Please try again or contact admin."
+        await query.edit_message_text(text, reply_markup=_VERIFIED_DOWNLOAD_KB, parse_mode="Markdown")
+    elif isinstance(edit_result, Exception):
+        logger.error(f"Error showing download message: {edit_result}")
     
-    # Clean up verification data
-    if token in smart_ad_system.user_sessions:
-        del smart_ad_system.user_sessions[token]
-    if 'current_verification' in context.user_data:
-        del context.user_data['current_verification']
+    # Clean up verification data; abandoned sessions expire from the TTLCache instead
+    smart_ad_system.user_sessions.pop(token, None)
+    context.user_data.pop('current_verification', None)
     
-    # Save user stats
-    save_user_stats()
+    # User stats changes are saved by the stats flush
 
 async def check_verification_status(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str):
     """Check and display verification status"""
     query = update.callback_query
-    await query.answer()
     
     is_verified, message = ad_verification.check_verification_status(token)
     
     if is_verified:
         text = f"✅ **Verification Complete!**\n\nYou can now download the file."
-        keyboard = [[InlineKeyboardButton("📥 Download Now", callback_data=f"verify_download_{token}")]]
+        keyboard = [[InlineKeyboardButton("📥 Download Now", callback_data=f"verify_download:{token}")]]
     else:
-        session = ad_verification.user_sessions.get(token, {})
-        material_title = session.get('material_info', {}).get('material_title', 'the file')
+        session = ad_verification.user_sessions.get(token)
+        material_title = session.material_info.get('material_title', 'the file') if session else 'the file'
         
-        if session.get('ad_clicked'):
-            if "Wait" in message:
-                remaining = int(message.split(" ")[1])
+        if session and session.ad_clicked:
+            if session.wait_start:
+                remaining = max(0, config.WAIT_TIME_SECONDS - int(time.time() - session.wait_start))
                 text = (
                     f"⏳ **Verification in Progress**\n\n"
                     f"Ad clicked ✅\n"
@@ -1628,12 +2035,12 @@ async def check_verification_status(update: Update, context: ContextTypes.DEFAUL
         
         keyboard = [
             [InlineKeyboardButton("🔗 Click Ad Link", url="#")],  # URL would be stored in context
-            [InlineKeyboardButton("✅ Verify & Download", callback_data=f"verify_download_{token}")],
-            [InlineKeyboardButton("🔄 Check Status", callback_data=f"check_status_{token}")]
+            [InlineKeyboardButton("✅ Verify & Download", callback_data=f"verify_download:{token}")],
+            [InlineKeyboardButton("🔄 Check Status", callback_data=f"check_status:{token}")]
         ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await edit_if_changed(query, text, reply_markup, parse_mode="Markdown")
 
 # Modified material selection to use ad verification
 async def select_material(update: Update, context: ContextTypes.DEFAULT_TYPE, material_index: int):
@@ -1655,10 +2062,8 @@ async def select_material(update: Update, context: ContextTypes.DEFAULT_TYPE, ma
             logger.info("User has free downloads available")
             # Free download available - use it
             free_used = smart_ad_system.use_free_download(user_id)
-            save_user_stats()
             
             query = update.callback_query
-            await query.answer()
             
             remaining_free = config.FREE_DOWNLOADS_ALLOWED - free_used
             reset_time = f"{int(user_status['hours_until_reset'])}h {int(user_status['minutes_until_reset'])}m"
@@ -1674,10 +2079,10 @@ async def select_material(update: Update, context: ContextTypes.DEFAULT_TYPE, ma
             is_search = 'search_results' in context.user_data
             
             if is_search:
-                callback_data = f"free_download_search_{material_index}"
+                callback_data = f"free_download_search:{material_index}"
                 logger.info(f"Search free download, callback: {callback_data}")
             else:
-                callback_data = f"free_download_{material_index}"
+                callback_data = f"free_download:{material_index}"
                 logger.info(f"Browse free download, callback: {callback_data}")
                 
             keyboard = [[InlineKeyboardButton("✅ Download Now", callback_data=callback_data)]]
@@ -1695,11 +2100,9 @@ async def select_material(update: Update, context: ContextTypes.DEFAULT_TYPE, ma
             return await show_ad_verification(update, context, material_index)
             
     except Exception as e:
-        logger.error(f"Error in select_material: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in select_material: {e}")
         
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text("❌ Error in download process. Please try again.")
         return await start(update, context)
 
@@ -1707,14 +2110,14 @@ async def handle_free_download(update: Update, context: ContextTypes.DEFAULT_TYP
     """Fixed free download handler"""
     try:
         query = update.callback_query
-        await query.answer()
         
         data = query.data
         logger.info(f"handle_free_download called with: {data}")
+        prefix, payload = _split_callback_data(data)
         
-        if data.startswith("free_download_search_"):
+        if prefix == "free_download_search":
             # Search path
-            material_index = int(data.replace("free_download_search_", ""))
+            material_index = int(payload)
             logger.info(f"Processing search free download index: {material_index}")
             
             results = context.user_data.get("search_results", [])
@@ -1725,86 +2128,64 @@ async def handle_free_download(update: Update, context: ContextTypes.DEFAULT_TYP
                 context.user_data["semester"] = result["semester"]
                 context.user_data["subject"] = result["subject"]
                 
-                # Find actual material index in database
-                materials = STUDY_MATERIALS.get(result["branch"], {}).get(result["semester"], {}).get(result["subject"], {}).get("materials", [])
-                actual_index = -1
-                for idx, mat in enumerate(materials):
-                    if mat.get("title") == result["material"].get("title"):
-                        actual_index = idx
-                        break
+                # Search results carry their index in the database
+                actual_index = result["material_index"]
                 
                 logger.info(f"Actual material index: {actual_index}")
-                
-                if actual_index != -1:
-                    await send_material_direct(update, context, actual_index)
-                else:
-                    await query.edit_message_text("❌ Material not found in database.")
+                await send_material_direct(update, context, actual_index)
             else:
                 await query.edit_message_text("❌ Search result not found.")
                 
         else:
             # Browse path
-            material_index = int(data.replace("free_download_", ""))
+            material_index = int(payload)
             logger.info(f"Processing browse free download index: {material_index}")
             await send_material_direct(update, context, material_index)
             
     except Exception as e:
-        logger.error(f"Error in handle_free_download: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in handle_free_download: {e}")
         
         query = update.callback_query
-        await query.answer()
         await query.edit_message_text("❌ Error processing free download. Please try again.")
         return await start(update, context)
 
+def _resolve_material(context, material_index):
+    """Material a download button points at: a search result, or one of the browsed subject's materials.
+    
+    Picking a search result also stores its branch/semester/subject in user_data.
+    Returns None if the index is out of range.
+    """
+    if 'search_results' in context.user_data:
+        results = context.user_data['search_results']
+        if material_index >= len(results):
+            return None
+        result = results[material_index]
+        context.user_data["branch"] = result["branch"]
+        context.user_data["semester"] = result["semester"]
+        context.user_data["subject"] = result["subject"]
+        return result["material"]
+    
+    key = (context.user_data.get("branch"), context.user_data.get("semester"), context.user_data.get("subject"))
+    materials = MATERIALS_INDEX.get(key, ())
+    if material_index >= len(materials):
+        return None
+    return materials[material_index]
+
 async def show_ad_verification(update: Update, context: ContextTypes.DEFAULT_TYPE, material_index: int):
     """Show ad verification for both browse and search paths"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     user_status = smart_ad_system.get_user_status(user_id)
     
     # Get material info based on context (browse or search)
-    material_title = ""
     is_search = 'search_results' in context.user_data
+    material = _resolve_material(context, material_index)
+    if material is None:
+        await query.edit_message_text("❌ Search result not found." if is_search else "❌ Material not found.")
+        return await start(update, context)
+    material_title = material["title"]
     
-    if is_search:
-        # Search path
-        results = context.user_data.get("search_results", [])
-        if material_index < len(results):
-            result = results[material_index]
-            branch = result["branch"]
-            semester = result["semester"]
-            subject = result["subject"]
-            material = result["material"]
-            material_title = material["title"]
-            
-            # Store in context for the verification process
-            context.user_data["branch"] = branch
-            context.user_data["semester"] = semester
-            context.user_data["subject"] = subject
-        else:
-            await query.edit_message_text("❌ Search result not found.")
-            return await start(update, context)
-    else:
-        # Browse path
-        branch = context.user_data.get("branch")
-        semester = context.user_data.get("semester")
-        subject = context.user_data.get("subject")
-        
-        materials = STUDY_MATERIALS.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", [])
-        if material_index >= len(materials):
-            await query.edit_message_text("❌ Material not found.")
-            return await start(update, context)
-        
-        material = materials[material_index]
-        material_title = material["title"]
-    
-    # Get random ad
-    ad = random.choice(config.ADS)
-    
-    # Generate verification token
     material_info = {
         'branch': context.user_data.get("branch"),
         'semester': context.user_data.get("semester"),
@@ -1814,7 +2195,19 @@ async def show_ad_verification(update: Update, context: ContextTypes.DEFAULT_TYP
         'is_search': is_search
     }
     
-    verification_token = smart_ad_system.generate_verification_token(user_id, material_info)
+    # Opening the same material again while its verification is pending keeps that token and ad
+    pending = context.user_data.get('current_verification')
+    session = smart_ad_system.user_sessions.get(pending['token']) if pending else None
+    reuse = (
+        session is not None and not session.completed
+        and session.material_info == material_info and pending['ad_id'] in _AD_BY_ID
+    )
+    if reuse:
+        verification_token = pending['token']
+        ad = _AD_BY_ID[pending['ad_id']]
+    else:
+        ad = pick_ad()
+        verification_token = smart_ad_system.generate_verification_token(user_id, material_info)
     
     # Create tracking URL
     tracking_url = ad['tracking_url'].format(user_id=user_id, token=verification_token)
@@ -1827,29 +2220,18 @@ async def show_ad_verification(update: Update, context: ContextTypes.DEFAULT_TYP
         'is_search': is_search
     }
     
-    # Create status message
-    status_text = (
-        f"📊 **Your Download Status**\n"
-        f"• Free downloads used: {user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-        f"• Free downloads reset in: {int(user_status['hours_until_reset'])}h {int(user_status['minutes_until_reset'])}m\n\n"
-    )
-    
-    text = (
-        f"{status_text}"
-        f"📢 **Ad Verification Required**\n\n"
-        f"To download **{material_title}**, please:\n\n"
-        f"1. 🔗 **Click the ad link below**\n"
-        f"2. ⏳ **Keep it open for {config.WAIT_TIME_SECONDS} seconds**\n"
-        f"3. ✅ **Return and click 'Verify & Download'**\n"
-        f"4. 🎉 **Get {config.TOKEN_DURATION_HOURS}-hour unlimited downloads!**\n\n"
-        f"**Ad Sponsor:** {ad['text']}\n\n"
-        f"This helps us keep the bot free! 🙏"
+    # Status header plus instructions
+    text = _AD_VERIF_TMPLS[ad['ad_id']].format(
+        free_used=user_status['free_remaining'],
+        reset_hours=int(user_status['hours_until_reset']),
+        reset_minutes=int(user_status['minutes_until_reset']),
+        title=material_title
     )
     
     keyboard = [
         [InlineKeyboardButton("🔗 Click Ad Link (Required)", url=tracking_url)],
-        [InlineKeyboardButton("✅ Verify & Download", callback_data=f"verify_download_{verification_token}")],
-        [InlineKeyboardButton("🔄 Check Status", callback_data=f"check_status_{verification_token}")],
+        [InlineKeyboardButton("✅ Verify & Download", callback_data=f"verify_download:{verification_token}")],
+        [InlineKeyboardButton("🔄 Check Status", callback_data=f"check_status:{verification_token}")],
         [InlineKeyboardButton("📊 My Status", callback_data="show_my_status")],
     ]
     
@@ -1861,165 +2243,78 @@ async def show_ad_verification(update: Update, context: ContextTypes.DEFAULT_TYP
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await edit_if_changed(query, text, reply_markup, parse_mode="Markdown")
     
-    # Track ad impression
-    stats = load_ad_stats()
-    stats['total_impressions'] += 1
-    if ad['ad_id'] not in stats['ad_clicks']:
-        stats['ad_clicks'][ad['ad_id']] = {'clicks': 0, 'conversions': 0}
-    save_ad_stats(stats)
+    # Track ad impression (a reused token is still the same impression)
+    if not reuse:
+        record_ad_impression(ad['ad_id'])
 
 async def show_user_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's download status with accurate 10-hour reset info"""
     query = update.callback_query
-    await query.answer()
     
     user_id = update.effective_user.id
     user_status = smart_ad_system.get_user_status(user_id)
+    text = _STATUS_TMPLS[user_status['status']].format_map(user_status)
     
-    # Force refresh the status to ensure latest reset time
-    user_status = smart_ad_system.get_user_status(user_id)
-    
-    if user_status['status'] == 'free_downloads':
-        reset_time = f"{int(user_status['hours_until_reset'])}h {int(user_status['minutes_until_reset'])}m"
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"🎉 **Free Downloads Available!**\n"
-            f"• Free downloads left: **{user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}**\n"
-            f"• Free downloads reset in: **{reset_time}**\n"
-            f"• Total downloads: {user_status['total_downloads']}\n\n"
-            f"💡 After {config.FREE_DOWNLOADS_ALLOWED} free downloads, watch one ad for {config.WAIT_TIME_SECONDS} seconds to get {config.TOKEN_DURATION_HOURS} hours of unlimited downloads!"
-        )
-    elif user_status['status'] == 'token_active':
-        token_time = f"{int(user_status['token_hours_left'])}h {int(user_status['token_minutes_left'])}m"
-        reset_time = f"{int(user_status['hours_until_reset'])}h {int(user_status['minutes_until_reset'])}m"
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"✅ **Token Active!**\n"
-            f"• Free downloads used: {user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-            f"• Token expires in: **{token_time}**\n"
-            f"• Free downloads reset in: {reset_time}\n"
-            f"• Total downloads: {user_status['total_downloads']}\n\n"
-            f"🎉 You can download **unlimited materials** until token expires!"
-        )
-    else:
-        reset_time = f"{int(user_status['hours_until_reset'])}h {int(user_status['minutes_until_reset'])}m"
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"📢 **Ad Watch Required**\n"
-            f"• Free downloads used: {config.FREE_DOWNLOADS_ALLOWED}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-            f"• Free downloads reset in: **{reset_time}**\n"
-            f"• Total downloads: {user_status['total_downloads']}\n\n"
-            f"💡 Watch one ad for **{config.WAIT_TIME_SECONDS} seconds** to get **{config.TOKEN_DURATION_HOURS} hours** of unlimited downloads!"
-        )
-    
-    keyboard = [
-        [InlineKeyboardButton("📚 Continue Browsing", callback_data="back_to_subjects")],
-        [InlineKeyboardButton("🔍 Search Materials", callback_data="search")],
-        [InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await edit_if_changed(query, text, _STATUS_KB, parse_mode="Markdown")
 
 
 async def send_material_direct(update: Update, context: ContextTypes.DEFAULT_TYPE, material_index: int):
     """Fixed direct material sending with error handling"""
     try:
         query = update.callback_query
-        await query.answer()
 
         # Track download
         user = update.effective_user
-        track_user_interaction(
-            user_id=user.id,
-            username=user.username or "No username",
-            first_name=user.first_name or "Unknown", 
-            action="download"
-        )
+        track_in_background(user, "download")
         
         logger.info(f"send_material_direct called with index: {material_index}")
         
         # Determine if this is from search or browse
         is_search = 'search_results' in context.user_data
         
-        branch = context.user_data.get("branch")
-        semester = context.user_data.get("semester") 
-        subject = context.user_data.get("subject")
-        
-        logger.info(f"Context - Branch: {branch}, Semester: {semester}, Subject: {subject}, Is Search: {is_search}")
+        material = _resolve_material(context, material_index)
+        if material is None:
+            await query.edit_message_text("❌ Search result not found." if is_search else "❌ Material not found.")
+            return
+        file_id = material.get("file_id")
+        material_title = material.get("title")
         
-        if is_search:
-            # Search path
-            results = context.user_data.get("search_results", [])
-            logger.info(f"Search results count: {len(results)}")
-            
-            if material_index < len(results):
-                result = results[material_index]
-                material = result["material"]
-                file_id = material.get("file_id")
-                material_title = material.get("title")
-                
-                # Update context with search result data
-                context.user_data["branch"] = result["branch"]
-                context.user_data["semester"] = result["semester"]
-                context.user_data["subject"] = result["subject"]
-            else:
-                await query.edit_message_text("❌ Search result not found.")
-                return
-        else:
-            # Browse path
-            materials = STUDY_MATERIALS.get(branch, {}).get(semester, {}).get(subject, {}).get("materials", [])
-            logger.info(f"Browse materials count: {len(materials)}")
-            
-            if material_index < len(materials):
-                material = materials[material_index]
-                file_id = material.get("file_id")
-                material_title = material.get("title")
-            else:
-                await query.edit_message_text("❌ Material not found.")
-                return
+        logger.info(f"Context - Branch: {context.user_data.get('branch')}, Semester: {context.user_data.get('semester')}, Subject: {context.user_data.get('subject')}, Is Search: {is_search}")
         
         logger.info(f"Material title: {material_title}, File ID: {file_id}")
         
         if not file_id:
             text = f"❌ File not available for: {material_title}\n\nPlease contact admin."
-            keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back_to_subjects")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(text, reply_markup=reply_markup)
+            await query.edit_message_text(text, reply_markup=_BACK_TO_SUBJECTS_KB)
             return
         
         # Send the file
         caption = f"📚 {material_title}\n\nEnjoy your study material! 📖"
         
         logger.info("Attempting to send document...")
-        await context.bot.send_document(
-            chat_id=query.message.chat_id,
+        chat_id = query.message.chat_id
+        await send_in_chat_order(chat_id, lambda: send_document_limited(
+            context.bot,
+            chat_id=chat_id,
             document=file_id,
             caption=caption,
             filename=f"{material_title}.pdf"
-        )
+        ))
         logger.info("Document sent successfully")
         
         text = f"✅ **{material_title}** has been sent!"
         
     except Exception as e:
-        logger.error(f"Error in send_material_direct: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in send_material_direct: {e}")
         text = f"❌ Error sending file: {str(e)}"
     
-    # Create appropriate navigation
-    keyboard = []
-    if is_search:
-        keyboard.append([InlineKeyboardButton("🔙 Back to Results", callback_data="back_to_search")])
-    else:
-        keyboard.append([InlineKeyboardButton("🔙 Back to Materials", callback_data="back_to_subjects")])
-    
-    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_start")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    # Navigate back to wherever the material was opened from
+    reply_markup = _SENT_FROM_SEARCH_KB if is_search else _SENT_FROM_BROWSE_KB
+    await send_in_chat_order(query.message.chat_id, lambda: query.edit_message_text(
+        text, reply_markup=reply_markup, parse_mode="Markdown"
+    ))
 
 
 # Donation system
@@ -2039,24 +2334,16 @@ async def show_donation_options(update: Update, context: ContextTypes.DEFAULT_TY
         "Thank you for your support! 🙏"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("💖 Copy UPI ID", callback_data="copy_upi")],
-        [InlineKeyboardButton("📞 Contact Admin", url="https://t.me/your_admin_bot")],
-        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.callback_query.edit_message_text(text, reply_markup=_DONATION_KB, parse_mode="Markdown")
     else:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=_DONATION_KB, parse_mode="Markdown")
     
     return START
 
 async def handle_donation_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle donation button clicks"""
     query = update.callback_query
-    await query.answer()
     
     if query.data == "copy_upi":
         # For UPI, we can't copy directly but we can show it prominently
@@ -2065,8 +2352,55 @@ async def handle_donation_buttons(update: Update, context: ContextTypes.DEFAULT_
     
     
 # Track donations
+# New donations are appended to a JSON-lines log, one record per line;
+# donations.json is the older single-array format and is still read
+DONATIONS_LOG = 'donations.jsonl'
+LEGACY_DONATIONS_FILE = 'donations.json'
+
+def _file_size(path):
+    """Size of path in bytes, 0 if it does not exist."""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+def iter_donations():
+    """Yield every donation record, oldest first."""
+    # Missing and empty files (the legacy one is usually just "[]") are skipped without parsing
+    if _file_size(LEGACY_DONATIONS_FILE) > 2:
+        try:
+            with open(LEGACY_DONATIONS_FILE, 'rb') as f:
+                yield from _json_loads(f.read())
+        except json.JSONDecodeError:
+            pass
+    
+    if _file_size(DONATIONS_LOG):
+        with open(DONATIONS_LOG, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield _json_loads(line)
+
+def load_donations():
+    """Load the donation log"""
+    return list(iter_donations())
+
+# Running totals for /donations, read from the log once and kept up to date by log_donation
+_DONATION_SUMMARY = {'count': 0, 'total': 0, 'recent': deque(maxlen=5)}
+
+def _add_to_donation_summary(donation):
+    _DONATION_SUMMARY['count'] += 1
+    _DONATION_SUMMARY['total'] += donation.get('amount', 0)
+    _DONATION_SUMMARY['recent'].append(donation)
+
+for _donation in iter_donations():
+    _add_to_donation_summary(_donation)
+
+def donation_summary():
+    """Return (count, total amount, last 5 donations)."""
+    return _DONATION_SUMMARY['count'], _DONATION_SUMMARY['total'], list(_DONATION_SUMMARY['recent'])
+
 def log_donation(user_id, amount, method):
-    """Log donation details"""
+    """Log donation details (appends one line; run via asyncio.to_thread from handlers)"""
     donation_data = {
         "user_id": user_id,
         "amount": amount,
@@ -2074,16 +2408,9 @@ def log_donation(user_id, amount, method):
         "timestamp": datetime.now().isoformat()
     }
     
-    try:
-        with open('donations.json', 'r') as f:
-            donations = json.load(f)
-    except:
-        donations = []
-    
-    donations.append(donation_data)
-    
-    with open('donations.json', 'w') as f:
-        json.dump(donations, f, indent=2)
+    with open(DONATIONS_LOG, 'a', encoding='utf-8') as f:
+        f.write(_json_dumps(donation_data) + '\n')
+    _add_to_donation_summary(donation_data)
     
     logger.info(f"Donation received: {amount} via {method} from user {user_id}")
 
@@ -2104,10 +2431,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "If you encounter any issues, please contact the administrator."
     )
     
-    keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.callback_query.edit_message_text(text, reply_markup=_BACK_TO_START_KB, parse_mode="Markdown")
     context.user_data['current_state'] = START
     return START
 
@@ -2138,25 +2462,17 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show admin statistics with user counts - safe version"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
     try:
         # Load stats with error handling
-        ad_stats = load_ad_stats()
+        ad_stats = AD_STATS_DATA
         user_stats = get_user_stats()
         
-        # Calculate material count safely
-        total_materials = 0
-        try:
-            for branch in STUDY_MATERIALS.values():
-                for semesters in branch.values():
-                    for subject_data in semesters.values():
-                        total_materials += len(subject_data.get("materials", []))
-        except Exception as e:
-            print(f"❌ Error counting materials: {e}")
-            total_materials = 0
+        # The search index holds one entry per material and is kept current on upload
+        total_materials = len(_ALL_MATERIALS)
         
         # Build the stats message safely
         text = (
@@ -2196,32 +2512,7 @@ async def my_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's download status via command"""
     user_id = update.effective_user.id
     user_status = smart_ad_system.get_user_status(user_id)
-    
-    if user_status['status'] == 'free_downloads':
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"🎉 **Free Downloads Available!**\n"
-            f"• Free downloads left: {user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-            f"• Total downloads: {user_status['total_downloads']}\n\n"
-            f"💡 After free downloads, watch one ad for {config.WAIT_TIME_SECONDS} seconds to get {config.TOKEN_DURATION_HOURS} hours of unlimited downloads!"
-        )
-    elif user_status['status'] == 'token_active':
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"✅ **Token Active!**\n"
-            f"• Free downloads used: {user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-            f"• Total downloads: {user_status['total_downloads']}\n"
-            f"• Token expires in: {user_status['token_hours_left']} hours\n\n"
-            f"🎉 You can download unlimited materials until token expires!"
-        )
-    else:
-        text = (
-            f"📊 **Your Download Status**\n\n"
-            f"📢 **Ad Watch Required**\n"
-            f"• Free downloads used: {user_status['free_remaining']}/{config.FREE_DOWNLOADS_ALLOWED}\n"
-            f"• Total downloads: {user_status['total_downloads']}\n\n"
-            f"💡 Watch one ad for {config.WAIT_TIME_SECONDS} seconds to get {config.TOKEN_DURATION_HOURS} hours of unlimited downloads!"
-        )
+    text = _STATUS_TMPLS[user_status['status']].format_map(user_status)
     
     await update.message.reply_text(text, parse_mode="Markdown")
 
@@ -2229,23 +2520,18 @@ async def my_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_donations(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show donation history"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
-    try:
-        with open('donations.json', 'r') as f:
-            donations = json.load(f)
-    except:
-        donations = []
+    count, total, recent = donation_summary()
     
-    if not donations:
+    if not count:
         text = "📈 **Donation History**\n\nNo donations received yet."
     else:
-        total = sum(d['amount'] for d in donations if 'amount' in d)
         text = f"📈 **Donation History**\n\nTotal Received: ₹{total}\n\nRecent Donations:\n"
         
-        for i, donation in enumerate(donations[-5:]):  # Show last 5
+        for donation in recent:  # Show last 5
             text += f"• ₹{donation.get('amount', 'N/A')} via {donation.get('method', 'Unknown')}\n"
     
     await update.message.reply_text(text, parse_mode="Markdown")
@@ -2260,7 +2546,7 @@ async def check_github(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Test load
-        data = github_storage.load_data()
+        data = await github_storage.aload_data()
         await update.message.reply_text(f"✅ GitHub connection working\nBranches: {len(data)}")
     except Exception as e:
         await update.message.reply_text(f"❌ GitHub error: {str(e)}")
@@ -2268,13 +2554,26 @@ async def check_github(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def force_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Force save current data to GitHub"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
-    global STUDY_MATERIALS
-    save_materials(STUDY_MATERIALS)
     await update.message.reply_text("💾 Force save initiated!")
+    # Same path as the save worker, so it can't race it or a user-stats flush
+    for branch in STUDY_MATERIALS:
+        schedule_materials_save(branch)
+    try:
+        ok = await save_pending_materials()
+    except Exception as e:
+        logger.error(f"Force save failed: {e}")
+        ok = False
+    if ok:
+        await update.message.reply_text("✅ All materials saved to GitHub.")
+    elif ok is None:
+        await update.message.reply_text("❌ GitHub storage is disabled, nothing was saved.")
+    else:
+        # save_pending_materials left the branches dirty for the background save
+        await update.message.reply_text("❌ Force save failed. Pending changes will be retried automatically.")
 
 async def check_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check storage status"""
@@ -2285,32 +2584,21 @@ async def check_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if github_storage:
         text += "✅ GitHub storage: **ENABLED**\n"
         text += f"📁 Repository: `{github_storage.repo}`\n"
+        if github_storage.read_only:
+            text += "🔒 Read-only: materials did not load completely, saves are refused until restart\n"
     else:
         text += "❌ GitHub storage: **DISABLED**\n"
         text += "💾 Using local storage only\n"
     
-    # Check local file
-    try:
-        if os.path.exists('study_materials.json'):
-            with open('study_materials.json', 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                total_materials = 0
-                for branch, semesters in data.items():
-                    for semester, subjects in semesters.items():
-                        for subject, subject_data in subjects.items():
-                            total_materials += len(subject_data.get("materials", []))
-                text += f"📊 Local file: **{total_materials}** materials across **{len(data)}** branches\n"
-        else:
-            text += "📁 Local file: **NOT FOUND**\n"
-    except Exception as e:
-        text += f"❌ Local file error: {str(e)}\n"
+    # Counts come from the in-memory materials and search index, no disk read
+    text += f"📊 Loaded: **{len(_ALL_MATERIALS)}** materials across **{len(STUDY_MATERIALS)}** branches\n"
     
     await update.message.reply_text(text, parse_mode="Markdown")
 
 async def user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show detailed user information"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
@@ -2347,7 +2635,7 @@ async def user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def check_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check if data is loaded correctly"""
     user = update.effective_user
-    if user.id not in config.ADMIN_IDS:
+    if user.id not in _ADMIN_IDS:
         await update.message.reply_text("❌ Admin access required.")
         return
     
@@ -2370,12 +2658,10 @@ async def check_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check local file
     try:
-        if os.path.exists('study_materials.json'):
-            with open('study_materials.json', 'r', encoding='utf-8') as f:
-                local_data = json.load(f)
-                text += f"\n💾 Local file: {len(local_data)} branches\n"
-        else:
-            text += "\n❌ Local file not found\n"
+        local_data = await asyncio.to_thread(load_local_materials)
+        text += f"\n💾 Local file: {len(local_data)} branches\n"
+    except FileNotFoundError:
+        text += "\n❌ Local file not found\n"
     except Exception as e:
         text += f"\n❌ Local file error: {str(e)}\n"
     
@@ -2383,6 +2669,127 @@ async def check_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 #--------------------------------------------------------------------------------------------------------------
 
+# Callback routing tables for handle_button (built here, once every handler is defined)
+_EXACT_HANDLERS = {
+    "show_my_status": _returns_start(show_user_status),
+    "browse": show_branches,
+    "help": show_help,
+    "search": start_search,
+    "upload_menu": show_upload_menu,
+    "donate": show_donation_options,
+    "copy_upi": _returns_start(handle_donation_buttons),
+    "copy_btc": _returns_start(handle_donation_buttons),
+    "donate_upi_qr": _returns_start(handle_donation_buttons),
+    "back_to_start": start,
+    "back_to_branches": show_branches,
+    "back_to_semesters": show_semesters,
+    "back_to_subjects": show_subjects,
+    "back_to_search": show_search_results,
+}
+_EXACT_HANDLERS.update({branch: _select_branch for branch in ("CSE", "ECE", "EEE", "Mech", "Civil")})
+_EXACT_HANDLERS.update({str(semester): _select_semester for semester in range(1, 9)})
+
+# Callbacks of the form "prefix:payload"; each handler gets the payload
+_PREFIX_HANDLERS = {
+    "verify_download": _handle_verification_button,
+    "check_status": _handle_verification_button,
+    "free_download": _handle_free_download_button,
+    "free_download_search": _handle_free_download_button,
+    "search_result": _handle_search_result,
+    "material": _handle_material,
+    "subject": _select_subject,
+}
+
+# Used by handle_verification, same "prefix:payload" scheme
+_VERIFICATION_HANDLERS = {
+    "verify_download": process_download_verification,
+    "check_status": check_verification_status,
+    "show_my_status": lambda update, context, _: show_user_status(update, context),
+}
+
+# Keep-alive web server and self-ping task, started in post_init
+_web_runner = None
+_ping_task = None
+
+async def post_init(application: Application) -> None:
+    """Start background tasks once the bot is initialized."""
+    global _save_task, _stats_flush_task, _user_stats_task, _ping_task, _web_runner
+    # Compile the search scan before the first update arrives
+    await asyncio.to_thread(warm_up_search)
+    
+    # Not Application.create_task: the application awaits those on stop, and these never end
+    _save_task = asyncio.create_task(_save_worker())
+    _stats_flush_task = asyncio.create_task(_stats_flush_worker())
+    _user_stats_task = asyncio.create_task(_user_stats_flush_worker())
+    
+    # Keep-alive web server and self-ping share the bot's event loop
+    _web_runner = await start_web_server()
+    _ping_task = asyncio.create_task(ping_server())
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background tasks and flush any unsaved materials and stats."""
+    if _save_task:
+        _save_task.cancel()
+    if _stats_flush_task:
+        _stats_flush_task.cancel()
+    if _user_stats_task:
+        _user_stats_task.cancel()
+    if _ping_task:
+        _ping_task.cancel()
+    if _web_runner:
+        await _web_runner.cleanup()
+    
+    if _materials_dirty.is_set():
+        logger.info("Saving pending materials before shutdown...")
+        await save_pending_materials()
+    
+    await flush_stats()
+    async with _user_stats_lock:
+        await asyncio.to_thread(flush_user_stats)
+
+class _OrjsonParameters:
+    """The two RequestData attributes HTTPXRequest.do_request reads, with values encoded by orjson."""
+    __slots__ = ("multipart_data", "json_parameters")
+    
+    def __init__(self, request_data):
+        self.multipart_data = {}
+        # Same rule as RequestParameter.json_value: strings are sent as they are
+        self.json_parameters = {
+            name: value if isinstance(value, str) else orjson.dumps(value).decode()
+            for name, value in request_data.parameters.items()
+        }
+
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that encodes keyboards and other nested parameters with orjson."""
+    
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        # Uploads keep PTB's own multipart handling
+        if request_data is not None and not request_data.contains_files:
+            request_data = _OrjsonParameters(request_data)
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+# Filters shared by the message handlers, built once
+_TEXT_MESSAGE = filters.TEXT & ~filters.COMMAND
+_PRIVATE_TEXT = _TEXT_MESSAGE & filters.ChatType.PRIVATE
+_PRIVATE_DOC = filters.Document.ALL & filters.ChatType.PRIVATE
+
+# Command name -> handler, registered in this order
+_COMMANDS = (
+    ("start", start),
+    ("stats", admin_stats),
+    ("donations", show_donations),
+    ("ad_stats", ad_stats),
+    ("toggle_ads", toggle_ads),
+    ("status", my_status),
+    ("debug", debug_user),
+    ("reset", reset_user),
+    ("github_status", check_github),
+    ("force_save", force_save),
+    ("storage", check_storage),
+    ("user_details", user_details),
+    ("check_data", check_data),
+)
+
 # Main function
 def main() -> None:
     """Start the bot."""
@@ -2403,49 +2810,37 @@ def main() -> None:
         print("❌ ERROR: Please set your bot token in config.py")
         return
         
-    # Start Flask in background thread
-    Thread(target=run_flask, daemon=True).start()
-
-    # Start background async ping
-    loop = asyncio.get_event_loop()
-    loop.create_task(ping_server())
-    
-    # Create the Application
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    # libuv-based event loop when available; must be set before the application runs
+    if uvloop:
+        uvloop.install()
+    
+    # Create the Application with pooled HTTP/2 connections shared by all handlers;
+    # long polling gets its own small pool so it never waits on handler calls
+    request_class = OrjsonHTTPXRequest if orjson else HTTPXRequest
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .request(request_class(connection_pool_size=64, connect_timeout=5, read_timeout=10, pool_timeout=5, http_version="2"))
+        .get_updates_request(HTTPXRequest(connection_pool_size=16))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add handlers - ORDER MATTERS!
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("stats", admin_stats))  # If you have this
-    application.add_handler(CommandHandler("donations", show_donations))  # If you have this
-    application.add_handler(CommandHandler("ad_stats", ad_stats))  # ADD THIS
-    application.add_handler(CommandHandler("toggle_ads", toggle_ads))  # ADD THIS
-    application.add_handler(CommandHandler("status", my_status))
-    # Add these to your main() function:
-    application.add_handler(CommandHandler("debug", debug_user))
-    application.add_handler(CommandHandler("reset", reset_user))
-    # Add to main():
-    application.add_handler(CommandHandler("github_status", check_github))
-    application.add_handler(CommandHandler("force_save", force_save))
-    application.add_handler(CommandHandler("storage", check_storage))
-    application.add_handler(CommandHandler("user_details", user_details))
-    # Add this handler to your main() function:
-    application.add_handler(CommandHandler("check_data", check_data))
-
-    # Team member upload handlers
-    application.add_handler(MessageHandler(
-        filters.Document.ALL & filters.ChatType.PRIVATE, 
-        handle_team_upload_file
-    ), group=1)
-    
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-        handle_team_upload_text
-    ), group=1)
-    
-    # Callback handlers
-    application.add_handler(CallbackQueryHandler(handle_button))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_admin_file))
+    application.add_handlers({
+        0: [
+            *(CommandHandler(name, callback) for name, callback in _COMMANDS),
+            CallbackQueryHandler(handle_button),
+            MessageHandler(_TEXT_MESSAGE, handle_message),
+            MessageHandler(filters.Document.ALL, handle_admin_file),
+        ],
+        # Team member upload handlers
+        1: [
+            MessageHandler(_PRIVATE_DOC, handle_team_upload_file),
+            MessageHandler(_PRIVATE_TEXT, handle_team_upload_text),
+        ],
+    })
     application.add_error_handler(error_handler)
 
     # Start the Bot
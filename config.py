@@ -11,10 +11,10 @@ GITHUB_TOKEN = os.getenv('GITHUB_TOKEN', '')
 GITHUB_REPO = os.getenv('GITHUB_REPO', '') # Format: "username/repository-name"
 
 # Your Telegram User ID (to get this, send /start to @userinfobot on Telegram)
-ADMIN_IDS = [6884754821]  # Replace with your actual Telegram ID
+ADMIN_IDS = frozenset({6884754821})  # Replace with your actual Telegram ID
 
 # Team Member User IDs (upload access only)
-TEAM_MEMBER_IDS = [6496152250, 555666777]  # Add your team members' Telegram IDs
+TEAM_MEMBER_IDS = frozenset({6496152250, 555666777})  # Add your team members' Telegram IDs
 
 # File paths
 DATA_FILE = "study_materials.json"
@@ -32,7 +32,8 @@ ADS = [
         "text": "Check this offer!",   # What message you want to show to the user
         "url": "https://www.effectivegatecpm.com/yv9u1th9?key=4a2f106694f2523d86540aa156311604",  # Direct ad link
         "ad_id": "egcpm_ad1",          # Unique ID for tracking internally
-        "tracking_url": "https://www.effectivegatecpm.com/yv9u1th9?key=4a2f106694f2523d86540aa156311604&user={user_id}"  # optional tracking pattern
+        "tracking_url": "https://www.effectivegatecpm.com/yv9u1th9?key=4a2f106694f2523d86540aa156311604&user={user_id}",  # optional tracking pattern
+        "weight": 1                    # optional whole number, how often this ad shows relative to the others
     }
 ]
 
@@ -1,40 +1,189 @@
+import asyncio
 import json
 import base64
+import copy
+import hashlib
 import requests
 import os
+import random
+import threading
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib json module
+    orjson = None
+
+try:
+    import pybase64 as b64
+except ImportError:  # pybase64 is optional, the stdlib base64 module has the same API
+    b64 = base64
+
+__all__ = [
+    'GitHubStorage', 'github_storage', 'init_github_storage',
+    'load_materials', 'save_materials', 'asave_materials', 'invalidate_cache',
+]
+
+# Seed data for a repository that has no materials file yet
+_INITIAL_DATA = {
+    "CSE": {
+        "4": {
+            "DBMS": {
+                "materials": [
+                    {
+                        "title": "Sample Material",
+                        "file_id": "",
+                        "type": "document",
+                        "keywords": ["sample"]
+                    },
+                ]
+            }
+        }
+    }
+}
+
+# A passed connection test is trusted for an hour so restarts skip the extra API call
+PREFLIGHT_MARKER = ".gh_ok"
+PREFLIGHT_TTL = 3600
+
+# Fetched files and their ETags, kept across restarts for conditional GETs
+ETAG_CACHE_DIR = ".gh_cache"
+
+# Branch written by both the contents API saves and commit_files
+GIT_REF = "heads/main"
+
+# Materials are stored one branch per file, so a new upload only re-sends its own branch
+BRANCH_DIR = "materials"
+
+# Requests are spread out once fewer than this many remain in the rate-limit window
+RATE_LIMIT_RESERVE = 50
+MAX_RETRY_AFTER = 60  # seconds; longer waits fail the call instead of stalling a save
+RATE_LIMIT_RETRIES = 4  # attempts after the first for a rate-limited call
+BACKOFF_BASE = 1.0  # seconds; doubled per attempt (with jitter) when GitHub gives no wait
+
+class RateLimitedSession(requests.Session):
+    """Session that follows GitHub's rate-limit headers.
+    
+    Calls are paced when the remaining budget runs low. A rate-limited 403/429 is
+    retried after Retry-After, the window reset, or an exponential backoff with
+    jitter, whichever applies. Blocking, so it must be used from worker threads
+    (as all GitHubStorage calls from the bot are).
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = 0.0
+    
+    def request(self, method, url, *args, **kwargs):
+        remaining = self.rate_limit_remaining
+        if remaining is not None and remaining < RATE_LIMIT_RESERVE:
+            # Spread what is left evenly over the rest of the window
+            time.sleep(max(0.0, self.rate_limit_reset - time.time()) / max(remaining, 1))
+        
+        response = super().request(method, url, *args, **kwargs)
+        self._track(response)
+        
+        for attempt in range(RATE_LIMIT_RETRIES):
+            wait = self._retry_wait(response, attempt)
+            if wait is None:
+                break
+            print(f"⏳ GitHub rate limited, retrying in {wait:.0f}s...")
+            time.sleep(wait)
+            response = super().request(method, url, *args, **kwargs)
+            self._track(response)
+        return response
+    
+    def _retry_wait(self, response, attempt):
+        """Seconds to wait before retrying a rate-limited response, None to give up"""
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            wait = float(retry_after)
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            wait = self.rate_limit_reset - time.time()
+        elif response.status_code == 429 or "rate limit" in response.text.lower():
+            # Secondary limits may come without a wait; back off 1s, 2s, 4s... with jitter
+            wait = BACKOFF_BASE * 2 ** attempt * random.uniform(1.0, 1.5)
+        else:
+            return None  # a plain 403 (permissions) won't get better
+        return max(wait, 0.0) if wait <= MAX_RETRY_AFTER else None
+    
+    def _track(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            self.rate_limit_remaining = int(remaining)
+            self.rate_limit_reset = float(response.headers.get("X-RateLimit-Reset", 0))
+
+def _encode(data: Dict[str, Any]) -> bytes:
+    """Compact UTF-8 JSON for upload"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _etag_cache_path(file_path: str) -> str:
+    """Local cache file for a repository path"""
+    return os.path.join(ETAG_CACHE_DIR, file_path.replace('/', '__'))
+
+def _blob_sha(raw: bytes) -> str:
+    """The SHA git (and the contents API) gives a file with these bytes"""
+    return hashlib.sha1(b"blob %d\0" % len(raw) + raw).hexdigest()
+
+def _make_session(token: str) -> requests.Session:
+    """Keep-alive session for the GitHub API; GETs are retried on gateway errors"""
+    session = RateLimitedSession()
+    session.headers["Authorization"] = f"token {token}"
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
 
 class GitHubStorage:
-    def __init__(self, token: str, repo: str, file_path: str = "study_materials.json"):
+    def __init__(self, token: str, repo: str, file_path: str = "study_materials.json", session: requests.Session = None):
         self.token = token
         self.repo = repo
         self.file_path = file_path
         self.base_url = f"https://api.github.com/repos/{repo}/contents"
+        self.git_url = f"https://api.github.com/repos/{repo}/git"
         self.headers = {
             "Authorization": f"token {token}",
             "Accept": "application/vnd.github.v3+json",
             "Content-Type": "application/json"
         }
+        # One connection pool for every call instead of a new TLS handshake each time
+        self.session = session or _make_session(token)
+        self.session.headers.update(self.headers)
+        # Last known blob SHA per file, so saves can skip the GET before their PUT
+        self._shas = {}
+        # False until the materials have been loaded from (or fully written to) BRANCH_DIR
+        self.has_branch_files = False
+        # Set when the materials could not be loaded completely; saves are refused so
+        # the partial in-memory copy never overwrites files on GitHub
+        self.read_only = False
+        # file path -> (ETag, parsed data); unchanged files are answered with a bodiless 304
+        self._etags = {}
+        # Total materials, for save commit messages; None until first counted
+        self.material_count = None
+        # (commit SHA, tree SHA) of the branch head after our last commit_files
+        self._head = None
     
-    def load_data(self) -> Dict[str, Any]:
+    def load_data(self, file_path: str = None) -> Dict[str, Any]:
         """Load JSON data from GitHub only - no local fallback"""
+        file_path = file_path or self.file_path
         try:
-            print(f"📥 Loading {self.file_path} from GitHub...")
-            url = f"{self.base_url}/{self.file_path}"
-            response = requests.get(url, headers=self.headers, timeout=10)
+            print(f"📥 Loading {file_path} from GitHub...")
+            response, data = self._fetch(file_path)
             
-            if response.status_code == 200:
-                content = response.json()['content']
-                cleaned_content = content.replace('\n', '')
-                decoded_content = base64.b64decode(cleaned_content).decode('utf-8')
-                data = json.loads(decoded_content)
+            if data is not None:
                 print(f"✅ Successfully loaded {len(data)} branches from GitHub")
                 return data
             elif response.status_code == 404:
                 print("⚠️ File not found on GitHub, creating initial structure...")
                 initial_data = self._get_initial_data()
-                self.save_data(initial_data)
+                self.save_data(initial_data, file_path)
                 return initial_data
             else:
                 print(f"❌ GitHub API Error {response.status_code}: {response.text}")
@@ -46,53 +195,272 @@ class GitHubStorage:
             # Return empty data instead of local fallback
             return self._get_initial_data()
     
-    def save_data(self, data: Dict[str, Any]) -> bool:
+    def save_data(self, data: Dict[str, Any], file_path: str = None, message: str = None) -> bool:
         """Save JSON data to GitHub only - no local saving"""
+        return self.save_file(_encode(data), file_path, message)
+    
+    def save_file(self, raw: bytes, file_path: str = None, message: str = None) -> bool:
+        """Save already encoded JSON bytes to GitHub"""
+        file_path = file_path or self.file_path
         try:
-            print(f"💾 Saving {len(data)} branches to GitHub...")
+            print(f"💾 Saving {file_path} to GitHub...")
             
-            # Get current file SHA
-            url = f"{self.base_url}/{self.file_path}"
-            get_response = requests.get(url, headers=self.headers, timeout=10)
-            
-            sha = None
-            if get_response.status_code == 200:
-                sha = get_response.json().get('sha')
-                print("📝 Updating existing GitHub file...")
-            elif get_response.status_code == 404:
-                print("📄 Creating new file on GitHub...")
-            else:
-                print(f"❌ Cannot access GitHub file: {get_response.status_code}")
-                return False
+            url = f"{self.base_url}/{file_path}"
             
             # Prepare content
-            content = json.dumps(data, indent=2, ensure_ascii=False)
-            encoded_content = base64.b64encode(content.encode('utf-8')).decode()
+            encoded_content = b64.b64encode(raw).decode('ascii')
             
             # Prepare payload
             payload = {
-                "message": f"Bot update: {len(data)} branches, {self._count_materials(data)} materials",
+                "message": message or f"Bot update: {file_path}",
                 "content": encoded_content,
                 "branch": "main"
             }
             
-            if sha:
-                payload["sha"] = sha
-            
-            # Send to GitHub
-            response = requests.put(url, headers=self.headers, json=payload, timeout=30)
+            # Use the SHA from the last load/save; look it up only if unknown or stale
+            for attempt in range(2):
+                if attempt or file_path not in self._shas:
+                    if not self._refresh_sha(url, file_path):
+                        return False
+                
+                sha = self._shas[file_path]
+                if sha:
+                    payload["sha"] = sha
+                else:
+                    payload.pop("sha", None)
+                
+                # Send to GitHub
+                response = self.session.put(url, json=payload, timeout=30)
+                
+                if response.status_code in [200, 201]:
+                    body = response.json()
+                    self._shas[file_path] = body['content']['sha']
+                    # The PUT made a commit too; commit_files can build on it directly
+                    commit = body.get('commit') or {}
+                    self._head = (commit['sha'], commit['tree']['sha']) if 'tree' in commit else None
+                    print("✅ Data successfully saved to GitHub!")
+                    return True
+                if response.status_code not in (409, 422):
+                    break
+                print("⚠️ GitHub file changed since last save, refreshing SHA...")
+                self._shas.pop(file_path, None)
             
-            if response.status_code in [200, 201]:
-                print("✅ Data successfully saved to GitHub!")
-                return True
-            else:
-                print(f"❌ GitHub save failed: {response.status_code}")
-                return False
+            print(f"❌ GitHub save failed: {response.status_code}")
+            return False
                 
         except Exception as e:
             print(f"❌ GitHub save error: {e}")
             return False
     
+    def _refresh_sha(self, url: str, file_path: str) -> bool:
+        """GET the file's current SHA into self._shas (None if it doesn't exist yet)"""
+        get_response = self.session.get(url, timeout=10)
+        
+        if get_response.status_code == 200:
+            self._shas[file_path] = get_response.json().get('sha')
+            print("📝 Updating existing GitHub file...")
+        elif get_response.status_code == 404:
+            self._shas[file_path] = None
+            print("📄 Creating new file on GitHub...")
+        else:
+            print(f"❌ Cannot access GitHub file: {get_response.status_code}")
+            return False
+        return True
+    
+    def _fetch(self, file_path: str):
+        """GET a file: (response, parsed data or None). If it is unchanged since the
+        last fetch the data comes from the ETag cache (a 304 does not count against the rate limit)"""
+        if file_path not in self._etags:
+            self._read_etag_cache(file_path)
+        cached = self._etags.get(file_path)
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = self.session.get(f"{self.base_url}/{file_path}", headers=headers, timeout=10)
+        
+        if response.status_code == 304:
+            return response, cached[1]
+        if response.status_code != 200:
+            return response, None
+        
+        data = self._decode(file_path, response.json())
+        etag = response.headers.get("ETag")
+        if etag:
+            self._etags[file_path] = (etag, data)
+            self._write_etag_cache(file_path, etag, data)
+        return response, data
+    
+    def _read_etag_cache(self, file_path: str):
+        """Seed the ETag cache from disk so the first load after a restart can be a 304"""
+        try:
+            with open(_etag_cache_path(file_path), 'rb') as f:
+                entry = orjson.loads(f.read()) if orjson else json.loads(f.read())
+            self._etags[file_path] = (entry['etag'], entry['data'])
+            self._shas[file_path] = entry['sha']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable ETag cache for {file_path}: {e}")
+    
+    def _write_etag_cache(self, file_path: str, etag: str, data: Dict[str, Any]):
+        """Keep the fetched file and its ETag on disk for the next restart"""
+        try:
+            os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+            with open(_etag_cache_path(file_path), 'wb') as f:
+                f.write(_encode({"etag": etag, "sha": self._shas.get(file_path), "data": data}))
+        except OSError as e:
+            print(f"⚠️ Could not write ETag cache for {file_path}: {e}")
+    
+    def _decode(self, file_path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Parse a contents API response, remembering the file's SHA"""
+        self._shas[file_path] = body.get('sha')
+        cleaned_content = body['content'].replace('\n', '')
+        raw = b64.b64decode(cleaned_content)
+        return orjson.loads(raw) if orjson else json.loads(raw.decode('utf-8'))
+    
+    def load_branch_files(self) -> Optional[Dict[str, Any]]:
+        """Load materials from the per-branch files in BRANCH_DIR, None if there are none yet.
+        Any other failure, including a single unreadable branch, makes the storage read-only"""
+        data = {}
+        try:
+            listing = self.session.get(f"{self.base_url}/{BRANCH_DIR}", timeout=10)
+            if listing.status_code == 404:
+                return None
+            if listing.status_code != 200:
+                raise RuntimeError(f"listing {BRANCH_DIR} returned {listing.status_code}")
+            
+            for entry in listing.json():
+                if entry.get('type') != 'file' or not entry['name'].endswith('.json'):
+                    continue
+                response, branch_data = self._fetch(entry['path'])
+                if branch_data is None:
+                    raise RuntimeError(f"{entry['path']} returned {response.status_code}")
+                data.update(branch_data)
+            
+            self.has_branch_files = True
+            print(f"✅ Successfully loaded {len(data)} branches from GitHub")
+        except Exception as e:
+            self.read_only = True
+            print(f"❌ Error loading branch files from GitHub: {e}")
+            print("🔒 GitHub storage is read-only until restart; materials will not be saved")
+        return data
+    
+    def load_legacy_materials(self) -> Dict[str, Any]:
+        """Load the single-file materials from before BRANCH_DIR; seed data for a new repository.
+        Failures other than a missing file make the storage read-only"""
+        try:
+            response, data = self._fetch(self.file_path)
+            if data is not None:
+                print(f"✅ Successfully loaded {len(data)} branches from GitHub")
+                return data
+            if response.status_code == 404:
+                print("⚠️ No materials on GitHub yet, starting from the initial structure...")
+                return self._get_initial_data()
+            raise RuntimeError(f"{self.file_path} returned {response.status_code}")
+        except Exception as e:
+            self.read_only = True
+            print(f"❌ Error loading materials from GitHub: {e}")
+            print("🔒 GitHub storage is read-only until restart; materials will not be saved")
+            return {}
+    
+    def save_branch_files(self, data: Dict[str, Any], branches: Iterable[str] = None,
+                          material_count: int = None, extra_files: Dict[str, bytes] = None) -> bool:
+        """Save each branch (or only the given branches) to its own file in BRANCH_DIR.
+        extra_files (path -> encoded JSON) go into the same commit"""
+        if branches is None:
+            branches = list(data)
+        branches = list(branches)
+        # Callers that keep a running total pass it; walking the whole tree is the cold-start fallback
+        if material_count is not None:
+            self.material_count = material_count
+        elif self.material_count is None:
+            self.material_count = self._count_materials(data)
+        message = f"Bot update: {len(branches)} branches, {self.material_count} materials"
+        
+        if len(branches) == 1 and not extra_files:
+            # One contents PUT is cheaper than the three calls of a tree commit
+            branch = branches[0]
+            return self.save_data({branch: data.get(branch, {})}, f"{BRANCH_DIR}/{branch}.json", message)
+        
+        files = {f"{BRANCH_DIR}/{branch}.json": _encode({branch: data.get(branch, {})}) for branch in branches}
+        if extra_files:
+            files.update(extra_files)
+        return self.commit_files(files, message)
+    
+    def commit_files(self, files: Dict[str, bytes], message: str) -> bool:
+        """Write several files in one commit through the Git Data API (raw UTF-8, no base64)"""
+        if not files:
+            return True
+        try:
+            print(f"💾 Committing {len(files)} files to GitHub...")
+            entries = [
+                {"path": path, "mode": "100644", "type": "blob", "content": raw.decode('utf-8')}
+                for path, raw in files.items()
+            ]
+            
+            # Build on the commit we made last; look the branch head up only if unknown or stale
+            for attempt in range(2):
+                if attempt or self._head is None:
+                    if not self._refresh_head():
+                        return False
+                parent, base_tree = self._head
+                
+                tree = self.session.post(f"{self.git_url}/trees", json={"base_tree": base_tree, "tree": entries}, timeout=30)
+                if tree.status_code != 201:
+                    print(f"❌ GitHub tree creation failed: {tree.status_code}")
+                    return False
+                tree_sha = tree.json()['sha']
+                
+                commit = self.session.post(
+                    f"{self.git_url}/commits",
+                    json={"message": message, "tree": tree_sha, "parents": [parent]},
+                    timeout=30,
+                )
+                if commit.status_code != 201:
+                    print(f"❌ GitHub commit failed: {commit.status_code}")
+                    return False
+                commit_sha = commit.json()['sha']
+                
+                # Not a fast-forward (someone else pushed): 422, rebuild on the new head
+                response = self.session.patch(f"{self.git_url}/refs/{GIT_REF}", json={"sha": commit_sha}, timeout=30)
+                if response.status_code == 200:
+                    self._head = (commit_sha, tree_sha)
+                    for path, raw in files.items():
+                        self._shas[path] = _blob_sha(raw)
+                    print("✅ Data successfully saved to GitHub!")
+                    return True
+                if response.status_code != 422:
+                    break
+                print("⚠️ GitHub branch moved since last commit, refreshing head...")
+                self._head = None
+            
+            print(f"❌ GitHub ref update failed: {response.status_code}")
+            return False
+        except Exception as e:
+            print(f"❌ GitHub commit error: {e}")
+            return False
+    
+    def _refresh_head(self) -> bool:
+        """GET the branch's head commit and its tree into self._head"""
+        ref = self.session.get(f"{self.git_url}/ref/{GIT_REF}", timeout=10)
+        if ref.status_code != 200:
+            print(f"❌ Cannot read GitHub branch head: {ref.status_code}")
+            return False
+        head = ref.json()['object']['sha']
+        commit = self.session.get(f"{self.git_url}/commits/{head}", timeout=10)
+        if commit.status_code != 200:
+            print(f"❌ Cannot read GitHub head commit: {commit.status_code}")
+            return False
+        self._head = (head, commit.json()['tree']['sha'])
+        return True
+    
+    # Async callers (bot handlers) must not block the event loop on the HTTP round trips
+    async def aload_data(self, file_path: str = None) -> Dict[str, Any]:
+        """load_data in a worker thread"""
+        return await asyncio.to_thread(self.load_data, file_path)
+    
+    async def asave_data(self, data: Dict[str, Any], file_path: str = None) -> bool:
+        """save_data in a worker thread"""
+        return await asyncio.to_thread(self.save_data, data, file_path)
+    
     def _count_materials(self, data: Dict[str, Any]) -> int:
         """Count total number of materials"""
         count = 0
@@ -104,26 +472,46 @@ class GitHubStorage:
     
     def _get_initial_data(self) -> Dict[str, Any]:
         """Get initial data structure"""
-        return {
-            "CSE": {
-                "4": {
-                    "DBMS": {
-                        "materials": [
-                            {
-                                "title": "Sample Material",
-                                "file_id": "",
-                                "type": "document", 
-                                "keywords": ["sample"]
-                            },
-                        ]
-                    }
-                }
-            }
-        }
+        # Callers keep the result as the live materials dict, so hand out a copy
+        return copy.deepcopy(_INITIAL_DATA)
 
 # Global instance
 github_storage = None
 
+# Last materials loaded or saved; read again from GitHub after MATERIALS_CACHE_TTL
+MATERIALS_CACHE_TTL = 600  # seconds
+_materials_cache = None
+_materials_cache_time = 0.0
+_materials_cache_lock = threading.Lock()
+
+def _set_materials_cache(materials):
+    global _materials_cache, _materials_cache_time
+    with _materials_cache_lock:
+        _materials_cache = materials
+        _materials_cache_time = time.monotonic()
+
+def invalidate_cache():
+    """Make the next load_materials() read from GitHub"""
+    _set_materials_cache(None)
+
+def _recent_preflight(repo: str) -> bool:
+    """True if the connection test for this repo passed within PREFLIGHT_TTL"""
+    try:
+        if time.time() - os.path.getmtime(PREFLIGHT_MARKER) > PREFLIGHT_TTL:
+            return False
+        with open(PREFLIGHT_MARKER, encoding='utf-8') as f:
+            return f.read().strip() == repo
+    except OSError:
+        return False
+
+def _mark_preflight(repo: str):
+    """Remember a passed connection test so quick restarts can skip it"""
+    try:
+        with open(PREFLIGHT_MARKER, 'w', encoding='utf-8') as f:
+            f.write(repo)
+    except OSError as e:
+        print(f"⚠️ Could not write {PREFLIGHT_MARKER}: {e}")
+
 def init_github_storage():
     """Initialize GitHub storage"""
     global github_storage
@@ -135,14 +523,20 @@ def init_github_storage():
         print("❌ GitHub storage: DISABLED - missing token or repo")
         return None
     
-    # Test connection
+    session = _make_session(token)
+    if _recent_preflight(repo):
+        github_storage = GitHubStorage(token, repo, session=session)
+        print(f"✅ GitHub storage initialized: {repo} (connection checked recently)")
+        return github_storage
+    
+    # Test connection; the storage keeps using the same session (and connection)
     test_url = f"https://api.github.com/repos/{repo}"
-    headers = {"Authorization": f"token {token}"}
     
     try:
-        response = requests.get(test_url, headers=headers, timeout=10)
+        response = session.get(test_url, timeout=5)
         if response.status_code == 200:
-            github_storage = GitHubStorage(token, repo)
+            github_storage = GitHubStorage(token, repo, session=session)
+            _mark_preflight(repo)
             print(f"✅ GitHub storage initialized: {repo}")
             return github_storage
         else:
@@ -160,14 +554,41 @@ def load_materials():
         print("❌ GitHub storage not available")
         return {}
     
-    return github_storage.load_data()
+    with _materials_cache_lock:
+        if _materials_cache is not None and time.monotonic() - _materials_cache_time < MATERIALS_CACHE_TTL:
+            return _materials_cache
+    
+    data = github_storage.load_branch_files()
+    if data is None:
+        # Not split into branch files yet; the first save writes them all
+        data = github_storage.load_legacy_materials()
+    if not github_storage.read_only:
+        # A partial load is not cached, so the next load tries GitHub again
+        _set_materials_cache(data)
+    return data
 
-def save_materials(materials):
-    """Save study materials to GitHub only"""
+def save_materials(materials, branches=None, material_count=None, extra_files=None):
+    """Save study materials to GitHub only - just the given branches if any.
+    extra_files (path -> encoded JSON) are committed along with them.
+    Returns None (not False) when GitHub storage is disabled, so callers don't retry"""
     global github_storage
     
     if not github_storage:
         print("❌ GitHub storage not available - cannot save")
-        return
+        return None
     
-    github_storage.save_data(materials)
+    if github_storage.read_only:
+        print("🔒 Materials were not fully loaded from GitHub - refusing to save")
+        return False
+    
+    _set_materials_cache(materials)
+    if not github_storage.has_branch_files:
+        branches = None
+    ok = github_storage.save_branch_files(materials, branches, material_count, extra_files)
+    if ok and branches is None:
+        github_storage.has_branch_files = True
+    return ok
+
+async def asave_materials(materials, branches=None, material_count=None, extra_files=None):
+    """save_materials in a worker thread, for use from the event loop"""
+    return await asyncio.to_thread(save_materials, materials, branches, material_count, extra_files)
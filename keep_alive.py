@@ -1,54 +1,64 @@
 #smart keep alive prg
-#flask for pinged by uptime robot and self ping if idel for too long
+#aiohttp web server pinged by uptime robot and self ping if idel for too long
+#runs on the bot's own event loop, no extra thread
 import asyncio
 import logging
 import aiohttp
 import time
-from flask import Flask, request
-from threading import Thread
+from aiohttp import web
 
 # === CONFIG ===
 URL = "https://notesbot-0r6v.onrender.com"  # <-- replace with your Render web URL
+HOST = "0.0.0.0"
+PORT = 8080
 PING_INTERVAL = 300  # 5 minutes
 INACTIVITY_LIMIT = 900  # 15 minutes; stop self-pings if site is already active
 
-app = Flask(__name__)
 last_activity = time.time()
 
-@app.route('/')
-def home():
+async def home(request):
     global last_activity
     last_activity = time.time()  # update when anyone (or UptimeRobot) hits it
-    return "Bot is alive!"
+    return web.Response(text="Bot is alive!")
 
-@app.route('/ping')
-def manual_ping():
-    return "Ping OK"
+async def manual_ping(request):
+    return web.Response(text="Ping OK")
 
-def run_flask():
-    app.run(host="0.0.0.0", port=8080)
+app = web.Application()
+app.add_routes([
+    web.get('/', home),
+    web.get('/ping', manual_ping),
+])
+
+async def start_web_server(host=HOST, port=PORT):
+    """Serve the keep-alive routes on the running event loop. Returns the runner."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Keep-alive server listening on {host}:{port}")
+    return runner
 
 async def ping_server():
     """Periodically ping the Render URL if idle for too long."""
     global last_activity
-    while True:
-        await asyncio.sleep(PING_INTERVAL)
-        idle_time = time.time() - last_activity
-        if idle_time < INACTIVITY_LIMIT:
-            logging.info("Skipping ping — recent activity detected.")
-            continue  # don’t ping if already active
-        try:
-            async with aiohttp.ClientSession() as session:
+    # One session for every ping, so a still-open connection (and the DNS cache) is reused
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            idle_time = time.time() - last_activity
+            if idle_time < INACTIVITY_LIMIT:
+                logging.info("Skipping ping — recent activity detected.")
+                continue  # don’t ping if already active
+            try:
                 async with session.get(URL) as resp:
                     logging.info(f"Self-ping successful ({resp.status})")
-        except Exception as e:
-            logging.warning(f"Self-ping failed: {e}")
+            except Exception as e:
+                logging.warning(f"Self-ping failed: {e}")
 
 def start_keep_alive():
-    """Start the Flask webserver and background ping task."""
-    Thread(target=run_flask).start()
+    """Run the webserver and background ping task on their own event loop."""
+    async def _run():
+        await start_web_server()
+        await ping_server()
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.create_task(ping_server())
-    loop.run_forever()
+    asyncio.run(_run())
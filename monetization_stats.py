@@ -10,12 +10,17 @@ def show_monetization_stats():
     except:
         ad_stats = {}
     
-    # Donation stats
+    # Donation stats: older array file plus the append-only log
     try:
         with open('donations.json', 'r') as f:
             donations = json.load(f)
     except:
         donations = []
+    try:
+        with open('donations.jsonl', 'r') as f:
+            donations.extend(json.loads(line) for line in f if line.strip())
+    except FileNotFoundError:
+        pass
     
     print("💰 Monetization Statistics")
     print("=" * 30)
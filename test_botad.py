@@ -0,0 +1,176 @@
+import asyncio
+
+import pytest
+
+import botad
+
+MATERIALS = {
+    "CSE": {
+        "3": {
+            "DBMS": {"materials": [
+                {"title": "Database Notes", "keywords": ["sql", "normalization"]},
+                {"title": "ER Diagrams", "keywords": ["er"]},
+            ]},
+            "OOP": {"materials": [
+                {"title": "C++ Basics", "keywords": ["classes"]},
+            ]},
+        },
+    },
+    "ECE": {
+        "4": {
+            "Signals": {"materials": [
+                {"title": "Fourier Notes", "keywords": ["transform"]},
+            ]},
+        },
+    },
+}
+
+
+@pytest.fixture
+def materials(monkeypatch):
+    """Search over MATERIALS; the real index is rebuilt afterwards"""
+    monkeypatch.setattr(botad, "STUDY_MATERIALS", MATERIALS)
+    botad.build_search_index()
+    yield
+    monkeypatch.undo()
+    botad.build_search_index()
+
+
+def titles(query, limit=None):
+    return [result["material"]["title"] for result in botad.search_materials(query, limit)]
+
+
+# Search index
+
+def test_search_prefix_matches_tokens(materials):
+    assert titles("data") == ["Database Notes"]
+    assert titles("norm") == ["Database Notes"]
+
+
+def test_search_needs_every_token(materials):
+    assert titles("notes") == ["Database Notes", "Fourier Notes"]
+    assert titles("fourier notes") == ["Fourier Notes"]
+    assert titles("database fourier") == []
+
+
+def test_search_includes_subject_and_branch_hits(materials):
+    assert titles("dbms") == ["Database Notes", "ER Diagrams"]
+    assert titles("ece") == ["Fourier Notes"]
+
+
+def test_search_adds_in_word_matches_after_token_hits(materials):
+    # "base" is not a token prefix of anything, only a substring of "database"
+    assert titles("base") == ["Database Notes"]
+    # "er" is a token of "ER Diagrams" and also inside "Fourier"
+    assert titles("er") == ["ER Diagrams", "Fourier Notes"]
+
+
+def test_search_without_word_characters_scans(materials):
+    assert titles("++") == ["C++ Basics"]
+    assert titles("") == []
+
+
+def test_search_limit(materials):
+    assert titles("er", limit=1) == ["ER Diagrams"]
+    assert titles("ou", limit=2) == ["Fourier Notes"]
+    assert titles("notes", limit=1) == ["Database Notes"]
+
+
+def test_search_sees_appended_materials(materials):
+    botad._index_material("ECE", "4", "Signals", 1, {"title": "Laplace Notes", "keywords": []})
+    botad._search_cached.cache_clear()
+    assert titles("laplace") == ["Laplace Notes"]
+
+
+# Upload details
+
+def test_parse_upload_details():
+    assert botad._parse_upload_details("CSE, 3, DBMS, Unit 1 Notes, SQL, Joins") == (
+        "CSE", "3", "DBMS", "Unit 1 Notes", ["sql", "joins"])
+
+
+@pytest.mark.parametrize("text, message", [
+    ("CSE, 3, DBMS, Notes", "Not enough details"),
+    ("IT, 3, DBMS, Notes, sql", "Invalid branch: IT"),
+    ("CSE, 9, DBMS, Notes, sql", "Invalid semester"),
+    ("CSE, 3, , Notes, sql", "Subject cannot be empty"),
+    ("CSE, 3, DBMS, , sql", "Title cannot be empty"),
+])
+def test_parse_upload_details_errors(text, message):
+    with pytest.raises(ValueError, match=message):
+        botad._parse_upload_details(text)
+
+
+# Callback dispatch
+
+@pytest.mark.parametrize("data, expected", [
+    ("material:5", ("material", "5")),
+    ("subject:Data Structures", ("subject", "Data Structures")),
+    ("verify_download:abc_d", ("verify_download", "abc_d")),
+    ("free_download_search:3", ("free_download_search", "3")),
+    # Callback data from before "prefix:payload"
+    ("material_5", ("material", "5")),
+    ("verify_download_abc_d", ("verify_download", "abc_d")),
+    ("free_download_2", ("free_download", "2")),
+    ("free_download_search_3", ("free_download_search", "3")),
+    ("show_my_status", ("show_my_status", "")),
+])
+def test_split_callback_data(data, expected):
+    assert botad._split_callback_data(data) == expected
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.answered = 0
+        self.edits = []
+
+    async def answer(self, *args, **kwargs):
+        self.answered += 1
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeUpdate:
+    def __init__(self, data):
+        self.callback_query = FakeQuery(data)
+
+
+def press(data):
+    """Run handle_button for a button with this callback data"""
+    update = FakeUpdate(data)
+
+    async def run():
+        state = await botad.handle_button(update, None)
+        await asyncio.sleep(0)  # let the background answer run
+        return state
+
+    return asyncio.run(run()), update.callback_query
+
+
+@pytest.mark.parametrize("data", ["material:4", "material_4"])
+def test_handle_button_dispatches_prefixed_data(monkeypatch, data):
+    calls = []
+
+    async def handler(update, context, payload):
+        calls.append(payload)
+        return botad.START
+
+    monkeypatch.setitem(botad._PREFIX_HANDLERS, "material", handler)
+    state, query = press(data)
+    assert state == botad.START
+    assert calls == ["4"]
+    assert query.answered == 1
+
+
+def test_handle_button_dispatches_exact_data(monkeypatch):
+    calls = []
+
+    async def handler(update, context):
+        calls.append(update.callback_query.data)
+        return botad.START
+
+    monkeypatch.setitem(botad._EXACT_HANDLERS, "back_to_start", handler)
+    press("back_to_start")
+    assert calls == ["back_to_start"]
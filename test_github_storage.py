@@ -0,0 +1,127 @@
+import base64
+import json
+
+import pytest
+
+import github_storage
+from github_storage import BRANCH_DIR, GitHubStorage
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body if body is not None else {}
+        self.headers = {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+def contents(data, sha="blob"):
+    """A contents API body for a JSON file"""
+    return {"sha": sha, "content": base64.b64encode(json.dumps(data).encode()).decode()}
+
+
+class FakeSession:
+    """Answers GETs from a path -> response table and records every call"""
+
+    def __init__(self, responses):
+        self.headers = {}
+        self.responses = responses
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        path = url.split("/contents/")[-1]
+        self.calls.append(("GET", path))
+        return self.responses.get(path, FakeResponse(404))
+
+    def put(self, url, json=None, **kwargs):
+        path = url.split("/contents/")[-1]
+        self.calls.append(("PUT", path))
+        return FakeResponse(201, {"content": {"sha": "new"}, "commit": {"sha": "c", "tree": {"sha": "t"}}})
+
+
+@pytest.fixture(autouse=True)
+def etag_cache(monkeypatch, tmp_path):
+    """Keep the on-disk ETag cache out of the working tree"""
+    monkeypatch.setattr(github_storage, "ETAG_CACHE_DIR", str(tmp_path))
+
+
+def storage(responses):
+    return GitHubStorage("token", "owner/repo", session=FakeSession(responses))
+
+
+def listing(*branches):
+    return FakeResponse(200, [
+        {"type": "file", "name": f"{branch}.json", "path": f"{BRANCH_DIR}/{branch}.json"}
+        for branch in branches
+    ])
+
+
+# Loading
+
+def test_load_branch_files():
+    gh = storage({
+        BRANCH_DIR: listing("CSE", "ECE"),
+        f"{BRANCH_DIR}/CSE.json": FakeResponse(200, contents({"CSE": {"1": {}}})),
+        f"{BRANCH_DIR}/ECE.json": FakeResponse(200, contents({"ECE": {}})),
+    })
+    assert gh.load_branch_files() == {"CSE": {"1": {}}, "ECE": {}}
+    assert gh.has_branch_files
+    assert not gh.read_only
+
+
+def test_load_branch_files_missing_dir():
+    gh = storage({})
+    assert gh.load_branch_files() is None
+    assert not gh.read_only
+
+
+@pytest.mark.parametrize("responses", [
+    {BRANCH_DIR: FakeResponse(500)},
+    {BRANCH_DIR: listing("CSE", "ECE"),
+     f"{BRANCH_DIR}/CSE.json": FakeResponse(200, contents({"CSE": {}})),
+     f"{BRANCH_DIR}/ECE.json": FakeResponse(502)},
+])
+def test_incomplete_load_is_read_only(responses):
+    gh = storage(responses)
+    gh.load_branch_files()
+    assert gh.read_only
+    assert not gh.has_branch_files
+
+
+def test_load_legacy_materials_error_is_read_only():
+    gh = storage({"study_materials.json": FakeResponse(500)})
+    assert gh.load_legacy_materials() == {}
+    assert gh.read_only
+
+
+# Saving
+
+def test_save_single_branch_uses_contents_api():
+    gh = storage({})
+    assert gh.save_branch_files({"CSE": {}, "ECE": {}}, ["CSE"], material_count=0)
+    assert ("PUT", f"{BRANCH_DIR}/CSE.json") in gh.session.calls
+
+
+def test_save_several_branches_commits_once(monkeypatch):
+    gh = storage({})
+    commits = []
+    monkeypatch.setattr(gh, "commit_files", lambda files, message: commits.append(sorted(files)) or True)
+    extra = {"user_stats.json": b"{}"}
+    assert gh.save_branch_files({"CSE": {}, "ECE": {}}, ["CSE", "ECE"], 0, extra)
+    assert commits == [[f"{BRANCH_DIR}/CSE.json", f"{BRANCH_DIR}/ECE.json", "user_stats.json"]]
+
+
+def test_save_materials_refuses_when_read_only(monkeypatch):
+    gh = storage({})
+    gh.read_only = True
+    monkeypatch.setattr(github_storage, "github_storage", gh)
+    assert github_storage.save_materials({"CSE": {}}) is False
+    assert gh.session.calls == []
+
+
+def test_save_materials_without_storage(monkeypatch):
+    monkeypatch.setattr(github_storage, "github_storage", None)
+    assert github_storage.save_materials({"CSE": {}}) is None
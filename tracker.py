@@ -1,20 +1,39 @@
 # tracker.py - Simple web server for ad tracking
-from flask import Flask, request, redirect
+# aiohttp app, same stack as keep_alive.py; handlers run on one event loop
 import json
 import time
+from aiohttp import web
+from cachetools import TTLCache
 
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib json module
+    orjson = None
 
-# In-memory storage for tracking
-click_data = {}
+routes = web.RouteTableDef()
 
-@app.route('/click')
-def track_click():
+# In-memory storage for tracking; tokens expire after an hour so memory stays bounded
+click_data = TTLCache(maxsize=100_000, ttl=3600)
+
+# Redirect targets per ad id, unknown ids go to the default
+_AD_URLS = {
+    'ad1': 'https://example.com/python-course',
+    'ad2': 'https://example.com/books',
+    'ad3': 'https://example.com/web-dev'
+}
+_DEFAULT_AD_URL = 'https://example.com'
+
+def _dumps(obj):
+    """JSON response body encoder"""
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
+
+@routes.get('/click')
+async def track_click(request):
     """Track ad clicks and redirect to actual ad"""
-    ad_id = request.args.get('ad')
-    user_id = request.args.get('user')
-    token = request.args.get('token')
-    
+    ad_id = request.query.get('ad')
+    user_id = request.query.get('user')
+    token = request.query.get('token')
+
     # Record click time
     if token:
         click_data[token] = {
@@ -24,27 +43,23 @@ def track_click():
             'verified': False
         }
         print(f"Ad click recorded: {ad_id} by user {user_id}")
-    
+
     # Redirect to actual ad URL
-    ad_urls = {
-        'ad1': 'https://example.com/python-course',
-        'ad2': 'https://example.com/books',
-        'ad3': 'https://example.com/web-dev'
-    }
-    
-    redirect_url = ad_urls.get(ad_id, 'https://example.com')
-    return redirect(redirect_url, code=302)
-
-@app.route('/verify')
-def verify_click():
+    raise web.HTTPFound(_AD_URLS.get(ad_id, _DEFAULT_AD_URL))
+
+@routes.get('/verify')
+async def verify_click(request):
     """Verify if ad was clicked (called by bot)"""
-    token = request.args.get('token')
-    
+    token = request.query.get('token')
+
     if token in click_data:
         click_data[token]['verified'] = True
-        return json.dumps({'status': 'success', 'clicked': True})
-    
-    return json.dumps({'status': 'success', 'clicked': False})
+        return web.json_response({'status': 'success', 'clicked': True}, dumps=_dumps)
+
+    return web.json_response({'status': 'success', 'clicked': False}, dumps=_dumps)
+
+app = web.Application()
+app.add_routes(routes)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    web.run_app(app, host='0.0.0.0', port=5000)
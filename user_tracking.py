@@ -1,11 +1,42 @@
 import json
+import os
+import threading
+from array import array
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib json module
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, the active-user count then loops in Python
+    np = None
+
+# Seconds between user-stats uploads; interactions in between only touch memory
+USER_STATS_FLUSH_INTERVAL = 60
+
+# Repository path of the aggregate stats
+USER_STATS_FILE = "user_stats.json"
+
+# Interactions not yet uploaded, one JSON line each; replayed on start after a crash
+EVENT_LOG = "user_stats.jsonl"
 
 class UserTracker:
     def __init__(self, github_storage):
         self.github_storage = github_storage
+        # track_user may run in worker threads; one update+save at a time
+        self._lock = threading.Lock()
         self.user_stats = self._load_user_stats()
+        # last_seen_ts of every user in one flat float array, kept current by _apply
+        self._ts_pos = {}
+        self._ts = array('d')
+        self._index_last_seen()
+        # Set by track_user, cleared once flush() has uploaded the change
+        self._dirty = self._replay_event_log() > 0
+        self._event_log = open(EVENT_LOG, 'ab')
     
     def _load_user_stats(self) -> Dict[str, Any]:
         """Load user statistics from GitHub"""
@@ -13,89 +44,163 @@ class UserTracker:
             return {"unique_users": {}, "total_interactions": 0}
         
         try:
-            # Load from a separate file for user stats
-            original_path = self.github_storage.file_path
-            self.github_storage.file_path = "user_stats.json"
-            
-            data = self.github_storage.load_data()
-            self.github_storage.file_path = original_path
-            return data
+            # Load from a separate file for user stats; passing the path keeps
+            # concurrent materials saves pointed at their own file
+            return self.github_storage.load_data(USER_STATS_FILE)
         except Exception as e:
             print(f"❌ Error loading user stats: {e}")
-            # Restore original path in case of error
-            if hasattr(self, 'github_storage') and self.github_storage:
-                self.github_storage.file_path = "study_materials.json"
             return {"unique_users": {}, "total_interactions": 0}
     
-    def _save_user_stats(self) -> bool:
-        """Save user statistics to GitHub"""
+    def _save_user_stats(self, raw: bytes) -> bool:
+        """Save encoded user statistics to GitHub"""
         if not self.github_storage:
             return False
         
         try:
-            original_path = self.github_storage.file_path
-            self.github_storage.file_path = "user_stats.json"
-            
-            success = self.github_storage.save_data(self.user_stats)
-            self.github_storage.file_path = original_path
-            return success
+            return self.github_storage.save_file(raw, USER_STATS_FILE)
         except Exception as e:
             print(f"❌ Error saving user stats: {e}")
-            if hasattr(self, 'github_storage') and self.github_storage:
-                self.github_storage.file_path = "study_materials.json"
             return False
     
+    def _index_last_seen(self):
+        """Fill the last-seen array from the loaded records"""
+        for user_id_str, user_data in self.user_stats["unique_users"].items():
+            last_seen = user_data.get("last_seen_ts")
+            if last_seen is None:
+                # Older records only have the ISO string; parse it once and keep the result
+                try:
+                    last_seen = datetime.fromisoformat(user_data["last_seen"]).timestamp()
+                except (KeyError, TypeError, ValueError):
+                    last_seen = 0.0
+                user_data["last_seen_ts"] = last_seen
+            self._ts_pos[user_id_str] = len(self._ts)
+            self._ts.append(last_seen)
+    
+    def _apply(self, user_id_str: str, username: str, first_name: str, action: str, now: str, now_ts: float):
+        """Count one interaction in self.user_stats"""
+        users = self.user_stats["unique_users"]
+        if user_id_str not in users:
+            users[user_id_str] = {
+                "username": username or "No username",
+                "first_name": first_name or "Unknown",
+                "first_seen": now,
+                "last_seen": now,
+                "last_seen_ts": now_ts,
+                "total_interactions": 1,
+                "actions": {action: 1}
+            }
+        else:
+            user = users[user_id_str]
+            user["last_seen"] = now
+            user["last_seen_ts"] = now_ts
+            user["total_interactions"] += 1
+            user["actions"][action] = user["actions"].get(action, 0) + 1
+        
+        pos = self._ts_pos.get(user_id_str)
+        if pos is None:
+            self._ts_pos[user_id_str] = len(self._ts)
+            self._ts.append(now_ts)
+        else:
+            self._ts[pos] = now_ts
+        
+        self.user_stats["total_interactions"] = self.user_stats.get("total_interactions", 0) + 1
+    
+    def _replay_event_log(self) -> int:
+        """Apply interactions logged but not uploaded before the last shutdown"""
+        count = 0
+        try:
+            with open(EVENT_LOG, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        event = orjson.loads(line) if orjson else json.loads(line)
+                        now = event["t"]
+                        self._apply(event["uid"], event["u"], event["f"], event["a"], now,
+                                    datetime.fromisoformat(now).timestamp())
+                        count += 1
+                    except Exception as e:
+                        print(f"⚠️ Skipping bad user event line: {e}")
+        except FileNotFoundError:
+            pass
+        if count:
+            print(f"📝 Replayed {count} unsaved user interactions")
+        return count
+    
     def track_user(self, user_id: int, username: str, first_name: str, action: str = "interaction"):
         """Track user interaction"""
-        try:
-            user_id_str = str(user_id)
-            
-            if user_id_str not in self.user_stats["unique_users"]:
-                self.user_stats["unique_users"][user_id_str] = {
-                    "username": username or "No username",
-                    "first_name": first_name or "Unknown",
-                    "first_seen": datetime.now().isoformat(),
-                    "last_seen": datetime.now().isoformat(),
-                    "total_interactions": 1,
-                    "actions": {action: 1}
-                }
+        with self._lock:
+            try:
+                user_id_str = str(user_id)
+                now_dt = datetime.now()
+                now = now_dt.isoformat()
+                self._apply(user_id_str, username, first_name, action, now, now_dt.timestamp())
+                
+                # Small appends go straight to the log; the aggregate is uploaded by flush()
+                event = {"uid": user_id_str, "u": username, "f": first_name, "a": action, "t": now}
+                self._event_log.write(orjson.dumps(event) + b"\n" if orjson else (json.dumps(event) + "\n").encode())
+                self._event_log.flush()
+                self._dirty = True
+                
+            except Exception as e:
+                print(f"❌ Error tracking user: {e}")
+    
+    def flush(self) -> bool:
+        """Save user statistics to GitHub if they changed since the last flush"""
+        # The upload runs without the lock, so track_user never waits on GitHub
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return True
+        raw, log_size = snapshot
+        if not self._save_user_stats(raw):
+            return False
+        self.saved(log_size)
+        return True
+    
+    def snapshot(self) -> Optional[Tuple[bytes, int]]:
+        """Encoded stats plus the event-log size they cover, or None if nothing changed.
+        For uploading together with other files; call saved() once the upload succeeds"""
+        with self._lock:
+            if not self._dirty:
+                return None
+            if orjson:
+                raw = orjson.dumps(self.user_stats)
             else:
-                self.user_stats["unique_users"][user_id_str]["last_seen"] = datetime.now().isoformat()
-                self.user_stats["unique_users"][user_id_str]["total_interactions"] += 1
-                self.user_stats["unique_users"][user_id_str]["actions"][action] = \
-                    self.user_stats["unique_users"][user_id_str]["actions"].get(action, 0) + 1
-            
-            self.user_stats["total_interactions"] = self.user_stats.get("total_interactions", 0) + 1
-            
-            # Save to GitHub in background (don't block on failure)
-            self._save_user_stats()
-            
-        except Exception as e:
-            print(f"❌ Error tracking user: {e}")
+                raw = json.dumps(self.user_stats, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            return raw, os.fstat(self._event_log.fileno()).st_size
+    
+    def saved(self, log_size: int):
+        """Drop the logged interactions covered by an uploaded snapshot, keeping any newer ones"""
+        with self._lock:
+            with open(EVENT_LOG, 'rb') as f:
+                f.seek(log_size)
+                newer = f.read()
+            self._event_log.truncate(0)
+            if newer:
+                self._event_log.write(newer)
+                self._event_log.flush()
+            self._dirty = bool(newer)
     
     def get_stats(self) -> Dict[str, Any]:
         """Get user statistics"""
         try:
-            unique_users_count = len(self.user_stats.get("unique_users", {}))
-            total_interactions = self.user_stats.get("total_interactions", 0)
-            
             # Calculate active users (last 30 days)
-            active_users = 0
             thirty_days_ago = datetime.now().timestamp() - (30 * 24 * 60 * 60)
-            
-            for user_data in self.user_stats.get("unique_users", {}).values():
-                try:
-                    last_seen = datetime.fromisoformat(user_data["last_seen"]).timestamp()
-                    if last_seen > thirty_days_ago:
-                        active_users += 1
-                except:
-                    continue
+            # track_user threads add users concurrently; callers get a copy to iterate
+            with self._lock:
+                user_details = dict(self.user_stats.get("unique_users", {}))
+                total_interactions = self.user_stats.get("total_interactions", 0)
+                if np is not None:
+                    # Zero-copy view; held under the lock so _apply cannot grow the array meanwhile
+                    active_users = int(np.count_nonzero(np.frombuffer(self._ts, dtype=np.float64) > thirty_days_ago))
+                else:
+                    active_users = sum(1 for last_seen in self._ts if last_seen > thirty_days_ago)
             
             return {
-                "unique_users": unique_users_count,
+                "unique_users": len(user_details),
                 "active_users": active_users,
                 "total_interactions": total_interactions,
-                "user_details": self.user_stats.get("unique_users", {})
+                "user_details": user_details
             }
         except Exception as e:
             print(f"❌ Error getting user stats: {e}")
@@ -107,6 +212,9 @@ user_tracker = None
 def init_user_tracker(github_storage):
     """Initialize user tracker"""
     global user_tracker
+    # A second tracker would replay and append to the same event log
+    if user_tracker is not None:
+        return user_tracker
     try:
         user_tracker = UserTracker(github_storage)
         print("✅ User tracker initialized")
@@ -123,6 +231,26 @@ def track_user_interaction(user_id: int, username: str, first_name: str, action:
     else:
         print(f"⚠️ User tracker not available for user {user_id}")
 
+def flush_user_stats():
+    """Upload pending user statistics"""
+    global user_tracker
+    if user_tracker:
+        return user_tracker.flush()
+    return False
+
+def user_stats_snapshot():
+    """UserTracker.snapshot() of the global tracker, None if there is nothing to upload"""
+    global user_tracker
+    if user_tracker:
+        return user_tracker.snapshot()
+    return None
+
+def user_stats_saved(log_size: int):
+    """Tell the global tracker its snapshot was uploaded"""
+    global user_tracker
+    if user_tracker:
+        user_tracker.saved(log_size)
+
 def get_user_stats():
     """Get user statistics"""
     global user_tracker